@@ -1,7 +1,9 @@
+import asyncio
 import chainlit as cl
 import openai
 import json
 import re
+import time
 from datetime import datetime
 from langsmith import traceable
 from langsmith.wrappers import wrap_openai
@@ -9,18 +11,52 @@ from chainlit.step import Step as cl_Step
 
 from config.config_llm import config, model_kwargs
 from prompts import BASE_SYSTEM_PROMPT, RAG_SYSTEM_PROMPT, LLM_FUNCTIONS, USER_MEMORY_CHECK_PROMPT
-from config.config_app import config_area
+from config.config_app import config_area, MEMORY_CHECK_TIMEOUT_SECONDS, RAG_CHECK_TIMEOUT_SECONDS
+from config.config_app import RAG_MAX_CONCURRENT_QUERIES, RAG_QUERY_TIMEOUT_SECONDS, RAG_RESPONSE_MODE
+from config.config_app import ANSWER_CACHE_SIMILARITY_THRESHOLD, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES_PER_SCHOOL
 
-from rag_pipeline import get_query_engine, get_schools_with_data, get_sources
+from rag_pipeline import get_index, get_query_engine, get_schools_with_data, get_sources, school_resolver
+from rag_pipeline import get_embed_model, get_served_index_version, get_retriever, build_retrieval_context
 from map_functions import get_travel_time, get_travel_time_based_on_arrival_time, get_travel_time_based_on_departure_time
 
-from helpers.memory_helper import get_formatted_memories, save_memories
+from helpers.memory_helper import get_formatted_memories, save_memories, memory_gate, DEFAULT_USER
+from helpers.router_helper import RagRouter
+from helpers.school_helper import query_qualifiers
+from helpers.history_helper import compact_history
+from helpers.token_helper import get_encoding
+from helpers.stream_helper import TokenStreamer
+from helpers.tool_helper import ToolRegistry, ToolCallCollector
+from helpers.cache_helper import SemanticCache
+from llama_index.core import QueryBundle
 from dotenv import load_dotenv
 load_dotenv()
 
 # Initialize the OpenAI async client
 client = wrap_openai(openai.AsyncClient(api_key=config["api_key"], base_url=config["endpoint_url"]))
 
+# Load the RAG index once at startup; every query shares it through the index holder
+get_index()
+# The token encoding used to budget the history is also loaded up front, since it may be downloaded
+get_encoding()
+
+# Routes clear-cut messages to the RAG (or away from it) without the check_rag LLM call
+rag_router = RagRouter(school_resolver)
+
+# Repeated questions about a school reuse the RAG context and sources of an earlier, near-identical query
+answer_cache = SemanticCache(ANSWER_CACHE_SIMILARITY_THRESHOLD, ANSWER_CACHE_TTL_SECONDS,
+                             ANSWER_CACHE_MAX_ENTRIES_PER_SCHOOL)
+
+# Tools the model can call, with the schemas from LLM_FUNCTIONS
+tool_registry = ToolRegistry(LLM_FUNCTIONS)
+for function_name, handler, batched in [
+    # Lookups through the travel time batcher share one Distance Matrix request per turn
+    ("get_travel_time", get_travel_time, True),
+    ("get_travel_time_based_on_arrival_time", get_travel_time_based_on_arrival_time, False),
+    ("get_travel_time_based_on_departure_time", get_travel_time_based_on_departure_time, True),
+]:
+    tool_registry.register(function_name, handler, tooltip='Made an external API call to get travel time',
+                           batched=batched)
+
 @traceable
 async def query_rag(client, message_history, message, school):
     # conversation_context = "\n".join([
@@ -31,21 +67,80 @@ async def query_rag(client, message_history, message, school):
     print("RAG query: " + rag_query)
     print("School: " + school)
 
-    query_engine = get_query_engine(school)
-    rag_response = query_engine.query(rag_query)
-    rag_context = str(rag_response)
-    
-    # Extract sources from the response
-    sources = get_sources(rag_response.source_nodes)
+    # Building the engine may (re)load the index from disk, so keep it off the event loop
+    if RAG_RESPONSE_MODE == "retrieval":
+        retriever = await asyncio.to_thread(get_retriever, school)
+    else:
+        query_engine = await asyncio.to_thread(get_query_engine, school)
+    index_version = get_served_index_version()
+
+    # The query is embedded once: for the answer cache lookup and, on a miss, for retrieval
+    query_embedding = await get_embed_model().aget_query_embedding(rag_query)
+    school_key = school_resolver.resolve(school) or school.lower()
+    # Near-identical embeddings are only trusted when the numbers and grade levels also match
+    qualifiers = query_qualifiers(message)
+    cached = answer_cache.get(school_key, query_embedding, index_version, qualifiers)
+    if cached is not None:
+        (rag_context, sources), similarity = cached
+        print(f"RAG answer cache hit (similarity {similarity:.3f}): {answer_cache.stats()}")
+        return rag_context, sources
+
+    # Retrieval and synthesis are awaited so other sessions keep streaming meanwhile
+    query_bundle = QueryBundle(rag_query, embedding=query_embedding)
+    if RAG_RESPONSE_MODE == "retrieval":
+        # The retrieved chunks go straight to the final response, skipping the synthesis LLM call
+        source_nodes = await retriever.aretrieve(query_bundle)
+        rag_context, sources = build_retrieval_context(source_nodes)
+    else:
+        rag_response = await query_engine.aquery(query_bundle)
+        rag_context = str(rag_response)
+        
+        # Extract sources from the response
+        sources = get_sources(rag_response.source_nodes)
     
     print("RAG reply: " + rag_context)
+    # Empty results (e.g. a school without data) are not cached, so they are retried once data exists
+    if sources and rag_context.strip() and rag_context != "Empty Response":
+        answer_cache.set(school_key, query_embedding, (rag_context, sources), index_version, qualifiers)
+    print(f"RAG answer cache miss: {answer_cache.stats()}")
     
     return rag_context, sources
 
 
+async def query_rag_with_limit(client, semaphore, message_history, rag_message, school):
+    async with semaphore:
+        print("rag message: " + rag_message)
+        print("School: " + school)
+        temporary_message_history = message_history.copy()
+        temporary_message_history.append({"role": "system", "Updated question to query:": rag_message})
+        return await query_rag(client, temporary_message_history, rag_message, school)
+
+
+async def run_rag_query(client, semaphore, message_history, rag_message_item, deadline):
+    rag_message = rag_message_item["question"]
+    school = rag_message_item["school"]
+    # The wait for a semaphore slot counts against the timeout, and no query runs past the check's deadline
+    timeout = min(RAG_QUERY_TIMEOUT_SECONDS, deadline - asyncio.get_running_loop().time())
+
+    start_time = time.perf_counter()
+    try:
+        rag_result = await asyncio.wait_for(
+            query_rag_with_limit(client, semaphore, message_history, rag_message, school), timeout)
+    except asyncio.TimeoutError:
+        print(f"RAG query timed out after {time.perf_counter() - start_time:.2f}s: {rag_message} ({school})")
+        return None
+    except Exception as e:
+        print(f"RAG query failed after {time.perf_counter() - start_time:.2f}s: {rag_message} ({school}): {e}")
+        return None
+
+    print(f"RAG query took {time.perf_counter() - start_time:.2f}s: {rag_message} ({school})")
+    return rag_result
+
+
 @traceable
-async def check_rag(client, message_history, message):
-    rag_check_message_history = message_history.copy()
+async def route_rag_with_llm(client, message_history, message):
+    # Asks the LLM which sub-questions to send to the RAG; returns [] when no school data is needed
+    rag_check_message_history = compact_history(message_history, "rag_check")
     rag_prompt = RAG_SYSTEM_PROMPT.format(schools_with_data=get_schools_with_data())
     rag_prompt_message = {"role": "system", "content": rag_prompt}
     if rag_check_message_history and rag_check_message_history[0]["role"] == "system":
@@ -62,50 +157,80 @@ async def check_rag(client, message_history, message):
         messages=rag_check_message_history,
         **model_kwargs)
     
-    updated_message_history = message_history.copy()
-    used_rag = False
     try:
         response_json = json.loads(response.choices[0].message.content)
-        print("Rag check reponse: " + str(response_json))
-        if response_json.get("fetch_school_data", False):
-            rag_messages = response_json.get("rag_messages", [])
-            print("Rag message: " + str(rag_messages))
-            rag_replies = []
-            for rag_message_item in rag_messages:
-                rag_message = rag_message_item["question"]
-                school = rag_message_item["school"]
-                print("rag message: " + rag_message)
-                print("School: " + school)
-                temporary_message_history = message_history.copy()
-                temporary_message_history.append({"role": "system", "Updated question to query:": rag_message})
-                rag_reply, rag_sources = await query_rag(client, temporary_message_history, rag_message, school)
-                
-                # Format the sources information
-                sources_info = "\n".join([
-                    f"Source {i+1}: {source['metadata'].get('source', 'Unknown')} "
-                    f"Type: {source['metadata'].get('type', 'Unknown')}, "
-                    f"Relevance: {source['score']:.2f})"
-                    for i, source in enumerate(rag_sources)
-                ])
-                
-                updated_message_history.append({
-                    "role": "assistant", 
-                    "content": f"COntext:\n{rag_reply}\n\nQuestion:\n{rag_message}\n\nSources:\n{sources_info}"
-                })
-                used_rag = True
     except json.JSONDecodeError:
-        pass
+        return []
+    print("Rag check reponse: " + str(response_json))
+    if not response_json.get("fetch_school_data", False):
+        return []
+    return response_json.get("rag_messages", [])
+
+@traceable
+async def check_rag(client, message_history, message, timeout=RAG_CHECK_TIMEOUT_SECONDS):
+    # Routing and every sub-question share one deadline, so results that finished in time are always kept
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    # The local router handles clear-cut messages; the LLM router is only asked when it is unsure
+    has_history = any(history_message["role"] == "user" for history_message in message_history)
+    decision = rag_router.route(message, has_history)
+    if rag_router.use_llm(decision):
+        rag_messages = await asyncio.wait_for(
+            route_rag_with_llm(client, message_history, message), deadline - loop.time())
+        rag_router.record_llm_result(decision, rag_messages)
+    else:
+        rag_messages = decision["rag_messages"]
+
+    updated_message_history = message_history.copy()
+    used_rag = False
+    if rag_messages:
+        print("Rag message: " + str(rag_messages))
+        # Run the sub-questions concurrently; gather keeps the results in the original order
+        semaphore = asyncio.Semaphore(RAG_MAX_CONCURRENT_QUERIES)
+        start_time = time.perf_counter()
+        rag_results = await asyncio.gather(*[
+            run_rag_query(client, semaphore, message_history, rag_message_item, deadline)
+            for rag_message_item in rag_messages
+        ])
+        print(f"RAG fan-out: {len(rag_messages)} queries in {time.perf_counter() - start_time:.2f}s")
+
+        for rag_message_item, rag_result in zip(rag_messages, rag_results):
+            if rag_result is None:
+                # Keep the results of the other sub-questions if one failed or timed out
+                continue
+            rag_message = rag_message_item["question"]
+            rag_reply, rag_sources = rag_result
+            
+            # Format the sources information
+            sources_info = "\n".join([
+                f"Source {i+1}: {source['metadata'].get('source', 'Unknown')} "
+                f"Type: {source['metadata'].get('type', 'Unknown')}, "
+                f"Relevance: {source['score']:.2f})"
+                for i, source in enumerate(rag_sources)
+            ])
+            
+            updated_message_history.append({
+                "role": "assistant", 
+                "content": f"COntext:\n{rag_reply}\n\nQuestion:\n{rag_message}\n\nSources:\n{sources_info}"
+            })
+            used_rag = True
     
     return updated_message_history, used_rag
 
+def get_user_id():
+    # Memories are namespaced per authenticated user; anonymous chats share the default namespace
+    user = cl.user_session.get("user")
+    return user.identifier if user else DEFAULT_USER
+
 async def add_system_tooltip(message):
     system_message = f'<span class="system-message">{message}</span>'
     await cl.Message(content=system_message, author="System").send()
 
 @traceable
-async def check_memories(message_history, message):
-    memories_message_history = message_history.copy()
-    memories = get_formatted_memories()
+async def check_memories(message_history, message, user_id=DEFAULT_USER):
+    memories_message_history = compact_history(message_history, "memory_check")
+    memories = get_formatted_memories(user_id)
     system_prompt = USER_MEMORY_CHECK_PROMPT.format(current_user_memories=memories)
 
 
@@ -124,21 +249,31 @@ async def check_memories(message_history, message):
         messages=memories_message_history,
         **model_kwargs)
     
+    # Return the updated memories instead of saving them, so the caller can apply them after responding
     try:
         response_json = json.loads(response.choices[0].message.content)
         print("Memory check reponse: " + str(response_json))
         if response_json.get("update_needed", False):
             updated_memories = response_json.get("memories", [])
             print("Updated memories: " + str(updated_memories))
-            save_memories(updated_memories)
-            return True
+            return updated_memories
         else:
             print("No memory update needed")
     except json.JSONDecodeError as e:
         print("Memory update error: " + str(e))
         pass
 
-    return False
+    return None
+
+
+async def await_task(task, name, default=None):
+    try:
+        return await task
+    except asyncio.TimeoutError:
+        print(f"{name} timed out")
+    except Exception as e:
+        print(f"{name} failed: {e}")
+    return default
 
 
 @traceable
@@ -146,51 +281,45 @@ async def generate_response(client, message_history):
     response_message = cl.Message(content="")
     await response_message.send()
 
+    # The full history stays in the session; only a compacted copy within the token budget is sent
     stream = await client.chat.completions.create(
-        messages=message_history, 
-        tools=LLM_FUNCTIONS,
+        messages=compact_history(message_history, "response"), 
+        tools=tool_registry.schemas(),
         tool_choice="auto",
         stream=True, 
         **model_kwargs)
 
-    full_response = ""
+    # Deltas are coalesced into a few frames per second instead of one websocket frame per token
+    streamer = TokenStreamer(response_message)
     is_tool_call = False
-    tool_calls = []
-    current_tool_call_index = None
-    current_tool_call = None
+    # Each tool call starts as soon as its arguments are complete, while the model is still streaming;
+    # calls to batched tools start together once the stream ends
+    tool_call_collector = ToolCallCollector(tool_registry)
     
     # print("Message history: " + str(message_history))
     
-    async for part in stream:
-        delta = part.choices[0].delta
-        
-        if delta.content:
-            await response_message.stream_token(delta.content)
-            full_response += delta.content
-
-        if delta.tool_calls:
-            is_tool_call = True
-            print("Tool calls: " + str(delta.tool_calls))
-            for tool_call in delta.tool_calls:
-                if tool_call.index is not current_tool_call_index:  # A new tool call is starting
-                    if current_tool_call:
-                        tool_calls.append(current_tool_call)
-                    current_tool_call = {
-                        "name": tool_call.function.name,
-                        "arguments": tool_call.function.arguments or ""
-                    }
-                    current_tool_call_index = tool_call.index
-                    print("Current tool call: " + str(current_tool_call_index))
-                else:
-                    if tool_call.function and tool_call.function.arguments:
-                        current_tool_call["arguments"] += tool_call.function.arguments
-                    elif tool_call.function and tool_call.function.name:
-                        current_tool_call["names"] += tool_call.function.name
-
-    if current_tool_call:
-        tool_calls.append(current_tool_call)
-
-    print("Tool calls: " + str(tool_calls))
+    try:
+        async for part in stream:
+            delta = part.choices[0].delta
+            
+            if delta.content:
+                await streamer.push(delta.content)
+
+            if delta.tool_calls:
+                is_tool_call = True
+                tool_call_collector.add(delta.tool_calls)
+    except BaseException:
+        # Calls already started must not outlive a failed or cancelled stream
+        tool_call_collector.cancel()
+        raise
+
+    tool_calls = tool_call_collector.finish()
+
+    await streamer.close()
+    full_response = streamer.text
+    print(f"Response streaming: {streamer.stats()}")
+    print(f"Tool calls: {[(tool_call['name'], tool_call['arguments']) for tool_call in tool_calls]} "
+          f"({tool_call_collector.started_during_stream} started during the stream)")
     await response_message.update()
     return response_message, full_response, message_history, is_tool_call, tool_calls
 
@@ -202,7 +331,7 @@ def on_chat_start():
     system_prompt = BASE_SYSTEM_PROMPT.format(
         config_area=config_area,
         current_date=current_date,
-        user_information=get_formatted_memories(),
+        user_information=get_formatted_memories(get_user_id()),
         schools_with_data=get_schools_with_data())
     message_history = [{"role": "system", "content": system_prompt}]
     cl.user_session.set("message_history", message_history)
@@ -238,16 +367,40 @@ async def set_starters():
 async def on_message(message: cl.Message):
     # Maintain an array of messages in the user session
     message_history = cl.user_session.get("message_history", [])
+    user_id = get_user_id()
     print("Chat interface: message received:" + message.content)
     
-    #  Check if we need to update memories
-    memory_updated = await check_memories(message_history, message.content)
-    if memory_updated:
-        await add_system_tooltip('Memory updated')
+    # Run the memory and RAG checks concurrently; the memory update only affects future prompts.
+    # The local gate skips the memory LLM call for messages without personal facts.
+    memory_decision = memory_gate.decide(message.content)
+    memory_task = None
+    if memory_decision != "skip":
+        memory_task = asyncio.create_task(asyncio.wait_for(
+            check_memories(message_history.copy(), message.content, user_id), MEMORY_CHECK_TIMEOUT_SECONDS))
+    # check_rag enforces its own deadline, so sub-questions that finished in time survive a slow fan-out
+    rag_task = asyncio.create_task(check_rag(client, message_history.copy(), message.content))
 
+    try:
+        await respond(message, message_history, rag_task)
+
+        # Apply the memory update once the response has been streamed
+        if memory_task is not None:
+            updated_memories = await await_task(memory_task, "Memory check")
+            if memory_decision == "sample":
+                memory_gate.record_sample(message.content, updated_memories is not None)
+            if updated_memories is not None:
+                save_memories(updated_memories, user_id)
+                await add_system_tooltip('Memory updated')
+    finally:
+        for task in (memory_task, rag_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def respond(message, message_history, rag_task):
     # Check if we need to fetch additional data and q
     await add_system_tooltip('Querying RAG for additional data...')
-    message_history, used_rag = await check_rag(client, message_history, message.content)
+    message_history, used_rag = await await_task(rag_task, "RAG check", default=(message_history, False))
     if used_rag:
         await add_system_tooltip('Loading additional data from RAG')
     else:
@@ -266,33 +419,17 @@ async def on_message(message: cl.Message):
         if not is_tool_call:
             break
         
-        for tool_call in tool_call_data:
-            print("Tool call: " + str(tool_call))            
-            function_name = tool_call["name"]
-            function_args = json.loads(tool_call["arguments"])
-            
-            if function_name is None:
-                continue
-            
-            print("Function name: " + function_name)
-            print("Function args: " + str(function_args))
-            
-            used_map_function = False
-            if function_name == "get_travel_time":
-                result = get_travel_time(**function_args)
-                used_map_function = True
-            elif function_name == "get_travel_time_based_on_arrival_time":
-                result = get_travel_time_based_on_arrival_time(**function_args)
-                used_map_function = True
-            elif function_name == "get_travel_time_based_on_departure_time":
-                result = get_travel_time_based_on_departure_time(**function_args)
-                used_map_function = True
-            else:
-                result = "Unknown function"
-                
-            if used_map_function:
-                await add_system_tooltip('Made an external API call to get travel time')
+        # Awaiting the calls in order keeps results in call order. The batched travel-time lookups were all
+        # started by finish(), within one batch window, so they share one matrix request.
+        tool_calls = [(tool_call["name"], tool_call["arguments"]) for tool_call in tool_call_data]
+        results = await asyncio.gather(*[tool_call["task"] for tool_call in tool_call_data])
+        print(f"Tool latency: {tool_registry.stats()}")
+
+        tooltips = {tool_registry.tooltip(function_name) for function_name, _ in tool_calls}
+        for tooltip in filter(None, tooltips):
+            await add_system_tooltip(tooltip)
 
+        for (function_name, function_args), result in zip(tool_calls, results):
             system_message = {
                 "role": "system",
                 "content": f"Function '{function_name}' was called with arguments {function_args}. The result is:\n{result}"
@@ -6,5 +6,62 @@ load_dotenv()
 
 CACHE_FOLDER = 'cache'
 
+# Timeouts for the pre-processing LLM calls that run concurrently in on_message
+MEMORY_CHECK_TIMEOUT_SECONDS = 30
+RAG_CHECK_TIMEOUT_SECONDS = 60
+
+# When to run the memory-check LLM call: "always", "gate" (only if the local pre-filter finds personal facts) or "never"
+MEMORY_CHECK_MODE = os.getenv("MEMORY_CHECK_MODE", "gate")
+# Share of gate-skipped messages that are still checked by the LLM to measure false negatives
+MEMORY_GATE_SAMPLE_RATE = float(os.getenv("MEMORY_GATE_SAMPLE_RATE", "0.05"))
+
+# How check_rag decides what to fetch: "on" (local router, LLM only when it is unsure),
+# "shadow" (LLM decides, the local router is only compared against it) or "off"
+RAG_ROUTER_MODE = os.getenv("RAG_ROUTER_MODE", "on")
+# Share of confident local routing decisions that are also sent to the LLM router to measure agreement
+RAG_ROUTER_AGREEMENT_SAMPLE_RATE = float(os.getenv("RAG_ROUTER_AGREEMENT_SAMPLE_RATE", "0.05"))
+
+# Fan-out of the RAG sub-questions produced by check_rag
+RAG_MAX_CONCURRENT_QUERIES = 3
+RAG_QUERY_TIMEOUT_SECONDS = 30  # Per sub-question, including the wait for a free slot
+
+# How query_rag builds the context for a sub-question: "compact" (an LLM synthesizes an answer from the
+# retrieved chunks) or "retrieval" (the top chunks are passed to the final response as-is, saving one LLM call)
+RAG_RESPONSE_MODE = os.getenv("RAG_RESPONSE_MODE", "compact")
+RAG_CONTEXT_TOKEN_BUDGET = 1500  # Retrieved chunk tokens per sub-question in retrieval mode
+RAG_CONTEXT_MIN_CHUNK_TOKENS = 50  # A chunk is not worth including once fewer tokens than this are left
+
+# Semantic cache of RAG answers per school; entries are dropped when the index version changes
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95  # Cosine similarity between query embeddings
+ANSWER_CACHE_TTL_SECONDS = 6 * 3600
+ANSWER_CACHE_MAX_ENTRIES_PER_SCHOOL = 256
+
+# Token budgets for the conversation history sent with each LLM call (excluding the system prompt)
+HISTORY_TOKEN_BUDGETS = {
+    "memory_check": 1500,
+    "rag_check": 3000,
+    "response": 8000,
+}
+HISTORY_RECENT_TURNS = 2  # Latest user turns always sent verbatim, including their RAG context and tool results
+
+# Streamed response text is sent to the browser in frames of up to this many characters or this long a wait
+STREAM_FLUSH_INTERVAL_SECONDS = 0.03
+STREAM_FLUSH_CHARS = 64
+
+# Tool calls requested by the model; a tool that times out returns an error result instead of blocking the turn
+TOOL_TIMEOUT_SECONDS = 15
+TOOL_MAX_CONCURRENCY = 8  # Concurrent calls per tool
+
+# Web crawler politeness and concurrency
+CRAWL_CONCURRENCY = 16  # Pages fetched at once across all sites
+CRAWL_PER_HOST_CONCURRENCY = 4
+CRAWL_PER_HOST_INTERVAL_SECONDS = 0.25  # Minimum spacing between request starts to one host
+CRAWL_TIMEOUT_SECONDS = 10
+
+# Bulk page fetches for ingestion (share the per-host politeness settings above)
+FETCH_TIMEOUT_SECONDS = 30
+FETCH_MAX_RETRIES = 2
+FETCH_BACKOFF_SECONDS = 5  # First retry waits 5-10s, doubling on every further attempt
+
 config_area = os.getenv("CONFIG_AREA_STRING")
 # print("Config area: " + config_area)
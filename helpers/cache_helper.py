@@ -1,5 +1,12 @@
 import json
 import os
+import re
+import sqlite3
+from array import array
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from config.config_app import CACHE_FOLDER
@@ -7,50 +14,254 @@ from helpers.base_helper import ensure_folder_exists
 
 load_dotenv()
 
-CACHE_FILE = 'data_cache.json'
-CACHE_FILE_PATH = os.path.join(CACHE_FOLDER, CACHE_FILE)
-SCRAPER_CACHE_FILE = 'scraper_cache.json'
-SCRAPER_CACHE_FILE_PATH = os.path.join(CACHE_FOLDER, SCRAPER_CACHE_FILE)
+CACHE_DB_FILE = 'data_cache.db'
+CACHE_DB_FILE_PATH = os.path.join(CACHE_FOLDER, CACHE_DB_FILE)
 CACHE_EXPIRY_DAYS = 30  # Cache expires after 30 days
+# Pages that change often are revalidated sooner (first matching URL pattern wins)
+CACHE_EXPIRY_DAYS_BY_URL_PATTERN = [
+    (r'/(events|calendar)', 1),
+    (r'/news', 3),
+    (r'/(admission|apply|tuition)', 7),
+]
+
+# Cache namespaces stored in the key-value store
+WEBSITE_CACHE = 'websites'
+PDF_CACHE = 'pdfs'
+SCRAPER_CACHE = 'scraper'
+
+EMBEDDING_CACHE_MAX_ENTRIES = 200000  # Least recently used embeddings are evicted beyond this
+SQLITE_MAX_VARIABLES = 900
+
+# Whole-file JSON caches from earlier versions, imported once into the key-value store
+LEGACY_CACHE_FILE_PATH = os.path.join(CACHE_FOLDER, 'data_cache.json')
+LEGACY_SCRAPER_CACHE_FILE_PATH = os.path.join(CACHE_FOLDER, 'scraper_cache.json')
+
+_thread_local = threading.local()
+_migration_lock = threading.Lock()
 
 
 def _ensure_cache_folder_exists():
     ensure_folder_exists(CACHE_FOLDER)
 
-def _load_cache(file):
-    _ensure_cache_folder_exists()
-    if os.path.exists(file):
-        with open(file, 'r') as f:
-            return json.load(f)
-    return None
-
-def _save_cache(cache, file):
-    _ensure_cache_folder_exists()
-    with open(file, 'w') as f:
-        json.dump(cache, f)
-        
-def load_cache():
-    cache = _load_cache(CACHE_FILE_PATH)
-    if cache is None:
-        cache = {'websites': {}, 'pdfs': {}}
+def _get_connection():
+    # SQLite connections cannot be shared across threads, so each thread opens its own
+    connection = getattr(_thread_local, 'connection', None)
+    if connection is None:
+        _ensure_cache_folder_exists()
+        connection = sqlite3.connect(CACHE_DB_FILE_PATH, timeout=30)
+        # WAL lets readers proceed while a writer commits
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )""")
+        connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        connection.commit()
+        _thread_local.connection = connection
+        _migrate_legacy_caches(connection)
+    return connection
+
+def _import_legacy_file(connection, file_path, namespaced_entries):
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, 'r') as f:
+        legacy_cache = json.load(f)
+
+    rows = [
+        (namespace, key, json.dumps(entry), entry.get('timestamp', datetime.now().isoformat()))
+        for namespace, entries in namespaced_entries(legacy_cache)
+        for key, entry in entries.items()
+    ]
+    # Entries written since the legacy file was last saved win over the imported ones
+    with connection:
+        connection.executemany(
+            'INSERT OR IGNORE INTO cache_entries (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)', rows)
+    try:
+        os.replace(file_path, file_path + '.migrated')
+    except FileNotFoundError:
+        pass  # Another process finished the migration first
+    print(f"Migrated {len(rows)} cache entries from {file_path}")
 
-    return cache
+def _migrate_legacy_caches(connection):
+    with _migration_lock:
+        _import_legacy_file(connection, LEGACY_CACHE_FILE_PATH, lambda cache: [
+            (WEBSITE_CACHE, cache.get('websites', {})),
+            (PDF_CACHE, cache.get('pdfs', {})),
+        ])
+        _import_legacy_file(connection, LEGACY_SCRAPER_CACHE_FILE_PATH, lambda cache: [
+            (SCRAPER_CACHE, cache),
+        ])
 
-def save_cache(cache):
-    _save_cache(cache, CACHE_FILE_PATH)
-    
-def load_scraper_cache():
-    cache = _load_cache(SCRAPER_CACHE_FILE_PATH)
-    if cache is None:
-        cache = {}
+def get_cache_entry(namespace, key):
+    row = _get_connection().execute(
+        'SELECT value FROM cache_entries WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+    return json.loads(row[0]) if row else None
 
-    return cache
+def set_cache_entry(namespace, key, entry):
+    # Each put is its own transaction, so a crash never leaves a partially written cache
+    connection = _get_connection()
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO cache_entries (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)',
+            (namespace, key, json.dumps(entry), datetime.now().isoformat()))
 
-def save_scraper_cache(cache):
-    # print(f"Saving scraper cache: {str(cache)}")
-    _save_cache(cache, SCRAPER_CACHE_FILE_PATH)
+def delete_cache_entry(namespace, key):
+    connection = _get_connection()
+    with connection:
+        connection.execute('DELETE FROM cache_entries WHERE namespace = ? AND key = ?', (namespace, key))
+
+def get_cached_embeddings(model, text_hashes):
+    # Returns {text_hash: embedding} for the hashes present in the cache and marks them as recently used
+    connection = _get_connection()
+    found = {}
+    for i in range(0, len(text_hashes), SQLITE_MAX_VARIABLES):
+        chunk = text_hashes[i:i + SQLITE_MAX_VARIABLES]
+        placeholders = ','.join('?' * len(chunk))
+        rows = connection.execute(
+            f'SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})',
+            (model, *chunk))
+        for text_hash, blob in rows:
+            found[text_hash] = array('d', blob).tolist()
+    if found:
+        now = time.time()
+        with connection:
+            connection.executemany(
+                'UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?',
+                [(now, model, text_hash) for text_hash in found])
+    return found
+
+def set_cached_embeddings(model, embeddings_by_hash, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+    connection = _get_connection()
+    now = time.time()
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO embeddings (model, text_hash, embedding, last_used) VALUES (?, ?, ?, ?)',
+            [(model, text_hash, array('d', embedding).tobytes(), now)
+             for text_hash, embedding in embeddings_by_hash.items()])
+        count = connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        if count > max_entries:
+            connection.execute(
+                'DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)',
+                (count - max_entries,))
 
         
-def is_cache_valid(timestamp):
+def get_cache_expiry_days(url):
+    for pattern, expiry_days in CACHE_EXPIRY_DAYS_BY_URL_PATTERN:
+        if re.search(pattern, url, re.IGNORECASE):
+            return expiry_days
+    return CACHE_EXPIRY_DAYS
+
+def is_cache_valid(timestamp, expiry_days=CACHE_EXPIRY_DAYS):
     cache_date = datetime.fromisoformat(timestamp)
-    return datetime.now() - cache_date < timedelta(days=CACHE_EXPIRY_DAYS)
\ No newline at end of file
+    return datetime.now() - cache_date < timedelta(days=expiry_days)
+
+
+class TTLCache:
+    """Small in-memory cache whose entries expire after ttl_seconds, evicting least recently used first."""
+
+    def __init__(self, ttl_seconds, max_size=1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SemanticCache:
+    """In-memory cache looked up by embedding similarity rather than exact key.
+
+    A lookup hits when an entry in the same namespace has the same guard and a cosine similarity of at least
+    similarity_threshold with the query embedding. The guard holds exact facts similarity cannot be trusted
+    with (e.g. the numbers in a question). Entries expire after ttl_seconds and are all dropped when the
+    version changes.
+    """
+
+    def __init__(self, similarity_threshold, ttl_seconds, max_entries_per_namespace=256):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries_per_namespace = max_entries_per_namespace
+        self._entries = {}  # namespace -> [(expires_at, guard, unit embedding, value)], oldest first
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _unit(self, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self, version):
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def get(self, namespace, embedding, version=None, guard=None):
+        # Returns (value, similarity) for the closest live entry with the same guard, or None
+        with self._lock:
+            self._check_version(version)
+            now = time.monotonic()
+            entries = [entry for entry in self._entries.get(namespace, []) if entry[0] >= now]
+            self._entries[namespace] = entries
+            candidates = [entry for entry in entries if entry[1] == guard]
+            if candidates:
+                similarities = np.stack([entry[2] for entry in candidates]) @ self._unit(embedding)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self.hits += 1
+                    return candidates[best][3], float(similarities[best])
+            self.misses += 1
+            return None
+
+    def set(self, namespace, embedding, value, version=None, guard=None):
+        with self._lock:
+            self._check_version(version)
+            entries = self._entries.setdefault(namespace, [])
+            entries.append((time.monotonic() + self.ttl_seconds, guard, self._unit(embedding), value))
+            if len(entries) > self.max_entries_per_namespace:
+                del entries[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate,
+                'entries': sum(len(entries) for entries in self._entries.values())}
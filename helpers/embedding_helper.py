@@ -0,0 +1,76 @@
+import hashlib
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from helpers.cache_helper import get_cached_embeddings, set_cached_embeddings
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Wraps an embedding model with an on-disk cache keyed by (model, chunk text hash).
+
+    Only document chunks go through the cache; query embeddings are passed straight to the base model.
+    """
+
+    _base_embedding = PrivateAttr()
+    _hits = PrivateAttr(default=0)
+    _misses = PrivateAttr(default=0)
+
+    def __init__(self, base_embedding, **kwargs):
+        super().__init__(
+            model_name=base_embedding.model_name,
+            embed_batch_size=base_embedding.embed_batch_size,
+            **kwargs)
+        self._base_embedding = base_embedding
+
+    @classmethod
+    def class_name(cls):
+        return "CachedEmbedding"
+
+    def stats(self):
+        total = self._hits + self._misses
+        hit_rate = self._hits / total if total else 0.0
+        return {'hits': self._hits, 'misses': self._misses, 'hit_rate': hit_rate}
+
+    def _lookup(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        cached = get_cached_embeddings(self.model_name, list(set(hashes)))
+        # Identical chunks within a batch are only embedded once
+        missing = {}
+        for text, hash_value in zip(texts, hashes):
+            if hash_value not in cached:
+                missing.setdefault(hash_value, text)
+        hit_count = sum(1 for hash_value in hashes if hash_value in cached)
+        self._hits += hit_count
+        self._misses += len(hashes) - hit_count
+        return hashes, cached, missing
+
+    def _store(self, hashes, cached, missing, new_embeddings):
+        computed = dict(zip(missing.keys(), new_embeddings))
+        if computed:
+            set_cached_embeddings(self.model_name, computed)
+        return [cached[hash_value] if hash_value in cached else computed[hash_value] for hash_value in hashes]
+
+    def _get_text_embeddings(self, texts):
+        hashes, cached, missing = self._lookup(texts)
+        new_embeddings = self._base_embedding._get_text_embeddings(list(missing.values())) if missing else []
+        return self._store(hashes, cached, missing, new_embeddings)
+
+    async def _aget_text_embeddings(self, texts):
+        hashes, cached, missing = self._lookup(texts)
+        new_embeddings = await self._base_embedding._aget_text_embeddings(list(missing.values())) if missing else []
+        return self._store(hashes, cached, missing, new_embeddings)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text):
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_query_embedding(self, query):
+        return self._base_embedding._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        return await self._base_embedding._aget_query_embedding(query)
@@ -0,0 +1,305 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urljoin, urlparse, urlunparse, parse_qsl, urlencode
+from urllib.robotparser import RobotFileParser
+
+import httpx
+from bs4 import BeautifulSoup
+
+from config.config_app import CRAWL_CONCURRENCY, CRAWL_PER_HOST_CONCURRENCY
+from config.config_app import CRAWL_PER_HOST_INTERVAL_SECONDS, CRAWL_TIMEOUT_SECONDS
+from config.config_app import FETCH_TIMEOUT_SECONDS, FETCH_MAX_RETRIES, FETCH_BACKOFF_SECONDS
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Referer': 'https://www.google.com/'
+}
+
+ROBOTS_USER_AGENT = '*'
+TRACKING_QUERY_PREFIXES = ('utm_', 'fbclid', 'gclid')
+RETRY_STATUS_CODES = {403, 429, 500, 502, 503, 504}
+MAX_BACKOFF_SECONDS = 60
+
+
+def create_async_client(max_connections=CRAWL_CONCURRENCY, timeout=CRAWL_TIMEOUT_SECONDS):
+    return httpx.AsyncClient(
+        headers=DEFAULT_HEADERS,
+        timeout=timeout,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+
+def canonicalize_url(url):
+    """Normalize a URL so trivially different spellings of the same page dedupe to one key."""
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or '').lower()
+    if parsed.port and not ((scheme == 'http' and parsed.port == 80) or (scheme == 'https' and parsed.port == 443)):
+        host = f"{host}:{parsed.port}"
+    path = parsed.path or '/'
+    if path != '/' and path.endswith('/'):
+        path = path.rstrip('/')
+    query = urlencode([
+        (key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not key.lower().startswith(TRACKING_QUERY_PREFIXES)
+    ])
+    # Fragments never change the page, so they are dropped
+    return urlunparse((scheme, host, path, '', query, ''))
+
+
+class HostThrottle:
+    """Limits concurrent requests per host and spaces out request starts to the same host."""
+
+    def __init__(self, per_host_concurrency=CRAWL_PER_HOST_CONCURRENCY,
+                 per_host_interval=CRAWL_PER_HOST_INTERVAL_SECONDS):
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_interval = per_host_interval
+        self._semaphores = {}
+        self._next_request_at = {}
+
+    @asynccontextmanager
+    async def slot(self, host):
+        semaphore = self._semaphores.setdefault(host, asyncio.Semaphore(self.per_host_concurrency))
+        async with semaphore:
+            # Reserve the start time before sleeping so concurrent waiters queue up behind each other
+            now = time.monotonic()
+            start_at = max(now, self._next_request_at.get(host, 0.0))
+            self._next_request_at[host] = start_at + self.per_host_interval
+            if start_at > now:
+                await asyncio.sleep(start_at - now)
+            yield
+
+
+class RobotsCache:
+    """Fetches and parses robots.txt once per host; unreachable robots files allow everything."""
+
+    def __init__(self, client):
+        self.client = client
+        self._parsers = {}
+
+    async def can_fetch(self, url):
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        if origin not in self._parsers:
+            self._parsers[origin] = asyncio.ensure_future(self._load(origin))
+        parser = await self._parsers[origin]
+        return parser is None or parser.can_fetch(ROBOTS_USER_AGENT, url)
+
+    async def _load(self, origin):
+        try:
+            response = await self.client.get(f"{origin}/robots.txt")
+        except httpx.HTTPError as e:
+            print(f"Could not fetch robots.txt for {origin}: {e}")
+            return None
+        if response.status_code != 200:
+            return None
+        parser = RobotFileParser()
+        parser.parse(response.text.splitlines())
+        return parser
+
+
+def conditional_headers(validators):
+    headers = {}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+async def fetch_url(client, semaphore, throttle, url, max_retries=FETCH_MAX_RETRIES,
+                    backoff_seconds=FETCH_BACKOFF_SECONDS, validators=None):
+    """Fetch one URL, retrying rate limits and server errors with a non-blocking backoff.
+
+    With validators (etag / last_modified) the request is conditional and a 304 leaves text as None.
+    """
+    start_time = time.perf_counter()
+    result = {'url': url, 'status': None, 'text': None, 'error': None, 'attempts': 0, 'latency': 0.0,
+              'not_modified': False, 'etag': None, 'last_modified': None}
+    headers = conditional_headers(validators)
+    for attempt in range(max_retries + 1):
+        result['attempts'] = attempt + 1
+        retry_after = None
+        try:
+            async with semaphore, throttle.slot(urlparse(url).netloc):
+                response = await client.get(url, headers=headers)
+            result['status'] = response.status_code
+            if response.status_code in (200, 304):
+                result['text'] = response.text if response.status_code == 200 else None
+                result['not_modified'] = response.status_code == 304
+                result['etag'] = response.headers.get('etag') or (validators or {}).get('etag')
+                result['last_modified'] = response.headers.get('last-modified') or (validators or {}).get('last_modified')
+                result['error'] = None
+                break
+            result['error'] = f"HTTP {response.status_code}"
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
+            retry_after = response.headers.get('retry-after')
+        except httpx.HTTPError as e:
+            result['error'] = str(e) or type(e).__name__
+
+        if attempt < max_retries:
+            delay = backoff_seconds * (2 ** attempt) * random.uniform(1, 2)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            delay = min(delay, MAX_BACKOFF_SECONDS)
+            print(f"{result['error']} for {url}. Retrying in {delay:.1f}s (Attempt {attempt + 2})")
+            # Only this fetch waits; the other URLs keep downloading meanwhile
+            await asyncio.sleep(delay)
+
+    result['latency'] = time.perf_counter() - start_time
+    return result
+
+async def fetch_urls(urls, concurrency=CRAWL_CONCURRENCY, max_retries=FETCH_MAX_RETRIES,
+                     backoff_seconds=FETCH_BACKOFF_SECONDS, validators=None):
+    """Fetch many URLs concurrently over one pooled client; results are returned in input order."""
+    validators = validators or {}
+    semaphore = asyncio.Semaphore(concurrency)
+    throttle = HostThrottle()
+    async with create_async_client(max_connections=concurrency, timeout=FETCH_TIMEOUT_SECONDS) as client:
+        return await asyncio.gather(*[
+            fetch_url(client, semaphore, throttle, url, max_retries, backoff_seconds, validators.get(url))
+            for url in urls
+        ])
+
+
+def extract_links(base_url, html):
+    soup = BeautifulSoup(html, 'html.parser')
+    return [urljoin(base_url, link['href']) for link in soup.find_all('a', href=True)]
+
+
+class Crawler:
+    """Concurrent breadth-first crawler sharing one connection pool across all sites."""
+
+    def __init__(self, url_filter, max_pages=100, concurrency=CRAWL_CONCURRENCY,
+                 per_host_concurrency=CRAWL_PER_HOST_CONCURRENCY,
+                 per_host_interval=CRAWL_PER_HOST_INTERVAL_SECONDS, respect_robots=True,
+                 page_handler=None):
+        self.url_filter = url_filter  # (url, root_domain) -> bool
+        self.page_handler = page_handler  # (url, root_link, html), called from a worker thread
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.throttle = HostThrottle(per_host_concurrency, per_host_interval)
+        self.respect_robots = respect_robots
+        self.pages_fetched = 0
+
+    async def crawl(self, root_links):
+        """Crawl every root link concurrently and return {root_link: [urls in discovery order]}."""
+        self._global_semaphore = asyncio.Semaphore(self.concurrency)
+        async with create_async_client(max_connections=self.concurrency) as client:
+            self._client = client
+            self._robots = RobotsCache(client)
+            results = await asyncio.gather(*[self._crawl_site(root_link) for root_link in root_links])
+        return dict(zip(root_links, results))
+
+    async def _crawl_site(self, root_link):
+        root_domain = urlparse(root_link).netloc
+        queue = asyncio.Queue()
+        seen = []
+        seen_keys = set()
+
+        async def enqueue(url):
+            # Dedup at enqueue time so a page is never queued twice
+            key = canonicalize_url(url)
+            if key in seen_keys or len(seen) >= self.max_pages:
+                return
+            seen_keys.add(key)
+            if self.respect_robots and not await self._robots.can_fetch(key):
+                print(f"Skipping {key}: disallowed by robots.txt")
+                return
+            seen.append(key)
+            queue.put_nowait(key)
+
+        async def worker():
+            while True:
+                url = await queue.get()
+                try:
+                    for new_url in await self._fetch_page(url, root_link):
+                        if self.url_filter(new_url, root_domain):
+                            await enqueue(new_url)
+                except Exception as e:
+                    print(f"Error scraping {url}: {str(e)}")
+                finally:
+                    queue.task_done()
+
+        await enqueue(root_link)
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, self.max_pages))]
+        try:
+            await queue.join()
+        finally:
+            for worker_task in workers:
+                worker_task.cancel()
+        return seen
+
+    async def _fetch_page(self, url, root_link):
+        async with self._global_semaphore, self.throttle.slot(urlparse(url).netloc):
+            try:
+                print(f"Scraping {url}")
+                response = await self._client.get(url)
+            except httpx.HTTPError as e:
+                print(f"Error scraping {url}: {str(e)}")
+                return []
+        self.pages_fetched += 1
+
+        if response.status_code != 200:
+            print(f"Skipping {url} because it returned status code {response.status_code}")
+            return []
+        if 'html' not in response.headers.get('content-type', 'text/html'):
+            return []
+        # Parsing is CPU bound, keep it off the event loop
+        links = await asyncio.to_thread(extract_links, url, response.text)
+        if self.page_handler is not None:
+            # Hand the body over so the page does not need to be downloaded a second time
+            try:
+                await asyncio.to_thread(self.page_handler, url, root_link, response.text)
+            except Exception as e:
+                print(f"Error processing {url}: {str(e)}")
+        return links
+
+
+if __name__ == "__main__":
+    # Benchmark the crawler against a local HTTP server with simulated network latency
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from helpers.web_helper import is_relevant_to_root_url
+
+    PAGE_COUNT = 100
+    LATENCY_SECONDS = 0.05
+
+    class BenchmarkHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/robots.txt':
+                self.send_response(404)
+                self.end_headers()
+                return
+            time.sleep(LATENCY_SECONDS)
+            page = int(self.path.rsplit('/', 1)[-1]) if self.path.startswith('/about/') else 0
+            links = "".join(f'<a href="/about/{(page * 7 + i) % PAGE_COUNT}#top">link</a>' for i in range(1, 6))
+            body = f"<html><body><p>Page {page}</p>{links}</body></html>".encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BenchmarkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root_link = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    settings = [
+        ("sequential", dict(concurrency=1, per_host_concurrency=1, per_host_interval=0)),
+        ("polite defaults", dict()),
+        ("concurrent", dict(concurrency=16, per_host_concurrency=16, per_host_interval=0)),
+    ]
+    for label, kwargs in settings:
+        crawler = Crawler(is_relevant_to_root_url, max_pages=PAGE_COUNT, **kwargs)
+        start_time = time.perf_counter()
+        links = asyncio.run(crawler.crawl([root_link]))[root_link]
+        elapsed = time.perf_counter() - start_time
+        print(f"{label}: {len(links)} pages in {elapsed:.2f}s ({crawler.pages_fetched / elapsed:.1f} pages/s)")
+    server.shutdown()
@@ -0,0 +1,89 @@
+from functools import lru_cache
+from helpers.token_helper import count_tokens
+from config.config_app import HISTORY_TOKEN_BUDGETS, HISTORY_RECENT_TURNS
+
+# Markers of the messages check_rag and respond add to the history
+RAG_CONTEXT_PREFIX = "COntext:\n"
+RAG_QUESTION_MARKER = "\n\nQuestion:\n"
+RAG_SOURCES_MARKER = "\n\nSources:\n"
+FUNCTION_RESULT_PREFIX = "Function '"
+FUNCTION_RESULT_MARKER = " The result is:\n"
+
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and separators the chat format adds to every message
+STUB_RESULT_CHARS = 200
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+# Call types whose prompt does not use fetched school data or tool results at all
+CONVERSATION_ONLY_CALL_TYPES = {"memory_check"}
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def _count_content_tokens(content):
+    return count_tokens(content)
+
+def message_tokens(message):
+    # History messages never change, so their token counts are memoized by content
+    return _count_content_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+def is_rag_context(message):
+    return message["role"] == "assistant" and (message.get("content") or "").startswith(RAG_CONTEXT_PREFIX)
+
+def is_function_result(message):
+    return message["role"] == "system" and (message.get("content") or "").startswith(FUNCTION_RESULT_PREFIX)
+
+def _stub(message):
+    # Replaces a stale RAG context or tool result with a short note of what it was
+    content = message["content"]
+    if is_rag_context(message):
+        question = content.split(RAG_QUESTION_MARKER, 1)[-1].split(RAG_SOURCES_MARKER, 1)[0].strip()
+        return {"role": message["role"], "content": f"(School data fetched earlier for: {question})"}
+    call, _, result = content.partition(FUNCTION_RESULT_MARKER)
+    if len(result) > STUB_RESULT_CHARS:
+        result = result[:STUB_RESULT_CHARS] + "..."
+    return {"role": message["role"], "content": f"{call}{FUNCTION_RESULT_MARKER}{result}"}
+
+def _recent_start(messages, recent_turns):
+    # Index of the first message of the last recent_turns turns; a turn's RAG context precedes its user message
+    user_indexes = [i for i, message in enumerate(messages) if message["role"] == "user"]
+    if len(user_indexes) <= recent_turns:
+        return 0
+    start = user_indexes[-recent_turns] if recent_turns else len(messages)
+    while start > 0 and is_rag_context(messages[start - 1]):
+        start -= 1
+    return start
+
+def compact_history(message_history, call_type, budget=None, recent_turns=HISTORY_RECENT_TURNS):
+    """Returns a copy of the history that fits the token budget of call_type.
+
+    The leading system prompt is always kept and not counted. Recent turns are kept verbatim; older RAG
+    context blocks and tool results are stubbed, and the oldest messages are dropped until the rest fits.
+    """
+    budget = HISTORY_TOKEN_BUDGETS[call_type] if budget is None else budget
+    system_messages = []
+    messages = list(message_history)
+    if messages and messages[0]["role"] == "system" and not is_function_result(messages[0]):
+        system_messages, messages = messages[:1], messages[1:]
+
+    if call_type in CONVERSATION_ONLY_CALL_TYPES:
+        messages = [message for message in messages if not (is_rag_context(message) or is_function_result(message))]
+
+    start = _recent_start(messages, recent_turns)
+    older = [_stub(message) if is_rag_context(message) or is_function_result(message) else message
+             for message in messages[:start]]
+    recent = messages[start:]
+
+    used_tokens = sum(message_tokens(message) for message in older + recent)
+    dropped = 0
+    while older and used_tokens > budget:
+        used_tokens -= message_tokens(older.pop(0))
+        dropped += 1
+    # After dropping, never start the conversation with an orphaned reply
+    while dropped and older and older[0]["role"] != "user":
+        used_tokens -= message_tokens(older.pop(0))
+        dropped += 1
+
+    compacted = system_messages + older + recent
+    if dropped or start:
+        print(f"History for {call_type}: {len(message_history)} -> {len(compacted)} messages, "
+              f"{used_tokens} tokens (budget {budget}, {dropped} dropped)")
+    return compacted
@@ -1,31 +1,135 @@
 import json
 import os
-from config.config_app import CACHE_FOLDER
+import random
+import re
+import threading
+from config.config_app import CACHE_FOLDER, MEMORY_CHECK_MODE, MEMORY_GATE_SAMPLE_RATE
 from helpers.base_helper import ensure_folder_exists
 
 
 MEMORY_FILE = 'user_memories.json'
 MEMORY_FILE_PATH = os.path.join(CACHE_FOLDER, MEMORY_FILE)
+DEFAULT_USER = 'default'  # Namespace used when the chat has no authenticated user
 
 def _ensure_memory_file_exists():
     ensure_folder_exists(CACHE_FOLDER)
 
-def get_memories():
-    _ensure_memory_file_exists()
-    try:
-        if os.path.exists(MEMORY_FILE_PATH):
-            with open(MEMORY_FILE_PATH, 'r') as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"Error loading memories: {e}")
-    return []
-
-def get_formatted_memories():
-    memories = get_memories()
+
+class MemoryStore:
+    """Keeps user memories in process memory and only re-reads the file when it changes on disk."""
+
+    def __init__(self, file_path=MEMORY_FILE_PATH):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._memories = {}  # user id -> list of memories
+        self._version = None
+
+    def _file_version(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _refresh(self):
+        version = self._file_version()
+        if version == self._version:
+            return
+        memories = {}
+        if version is not None:
+            try:
+                with open(self.file_path, 'r') as f:
+                    data = json.load(f)
+                # Files written before namespaces existed hold a single list of memories
+                memories = {DEFAULT_USER: data} if isinstance(data, list) else data.get('users', {})
+            except Exception as e:
+                print(f"Error loading memories: {e}")
+        self._memories = memories
+        self._version = version
+
+    def get(self, user_id=DEFAULT_USER):
+        with self._lock:
+            self._refresh()
+            return list(self._memories.get(user_id, []))
+
+    def save(self, memories, user_id=DEFAULT_USER):
+        with self._lock:
+            # Pick up writes from other processes so their users' memories are not overwritten
+            self._refresh()
+            self._memories[user_id] = list(memories)
+
+            _ensure_memory_file_exists()
+            # Write to a temp file and rename it over the old one, so readers never see a partial file
+            tmp_path = f"{self.file_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'users': self._memories}, f)
+            os.replace(tmp_path, self.file_path)
+            self._version = self._file_version()
+
+
+_memory_store = MemoryStore()
+
+def get_memories(user_id=DEFAULT_USER):
+    return _memory_store.get(user_id)
+
+def get_formatted_memories(user_id=DEFAULT_USER):
+    memories = get_memories(user_id)
     return "\n".join([f"- {memory}" for i, memory in enumerate(memories)])
 
-def save_memories(memories):
-    _ensure_memory_file_exists()
+def save_memories(memories, user_id=DEFAULT_USER):
     print("Saving memories: " + str(memories))
-    with open(MEMORY_FILE_PATH, 'w') as f:
-        json.dump(memories, f)
\ No newline at end of file
+    _memory_store.save(memories, user_id)
+
+
+# Weighted cues that a message carries personal facts worth remembering; a tiny hand-tuned linear classifier
+MEMORY_GATE_FEATURES = [
+    (r"\b(i|i'm|im|i've|ive|i'd|my|mine|me|we|we're|our|ours|us)\b", 1.0),
+    (r"\b(kids?|sons?|daughters?|child|children|twins?|toddler|family|husband|wife|spouse|partner)\b", 1.5),
+    (r"\b(live|living|moving|move|moved|relocat\w*|budget|afford|prefer\w*|interested|care about|"
+     r"looking for|allerg\w*|special needs|learning|work|commute from|years? old|grade|age)\b", 1.0),
+    (r"\d", 0.5),
+]
+MEMORY_GATE_THRESHOLD = 1.5
+
+
+class MemoryGate:
+    """Decides locally whether a message needs the memory-check LLM call, and tracks how often it skips."""
+
+    def __init__(self, mode=MEMORY_CHECK_MODE, sample_rate=MEMORY_GATE_SAMPLE_RATE, threshold=MEMORY_GATE_THRESHOLD):
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self._features = [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in MEMORY_GATE_FEATURES]
+        self.messages = 0
+        self.skipped = 0
+        self.sampled = 0
+        self.false_negatives = 0
+
+    def score(self, message):
+        return sum(weight for pattern, weight in self._features if pattern.search(message))
+
+    def decide(self, message):
+        # Returns "check", "skip" or "sample" (skipped by the gate but checked anyway to measure misses)
+        self.messages += 1
+        if self.mode == "always":
+            return "check"
+        if self.mode != "never" and self.score(message) >= self.threshold:
+            return "check"
+
+        self.skipped += 1
+        if self.mode == "gate" and random.random() < self.sample_rate:
+            self.sampled += 1
+            decision = "sample"
+        else:
+            decision = "skip"
+        print(f"Memory gate: skipped memory check ({self.skipped}/{self.messages} skipped, "
+              f"{self.skipped / self.messages:.0%} skip rate)")
+        return decision
+
+    def record_sample(self, message, update_needed):
+        if update_needed:
+            self.false_negatives += 1
+            print(f"Memory gate false negative ({self.false_negatives}/{self.sampled} samples): {message}")
+
+
+memory_gate = MemoryGate()
@@ -1,58 +1,160 @@
 from dotenv import load_dotenv
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from llama_index.core import Document
-from helpers.cache_helper import load_cache, save_cache, is_cache_valid
+from helpers.cache_helper import get_cache_entry, set_cache_entry, PDF_CACHE
+import hashlib
 import pdfplumber
 import os
 
 load_dotenv()
 
+PDF_MAX_WORKERS = min(4, os.cpu_count() or 1)
+PDF_PAGES_PER_TASK = 25  # Large PDFs are split into page ranges extracted by separate workers
+
+def iter_pdf_pages(pdf_path, start=0, end=None):
+    # Streams page text one page at a time, dropping each page's parsed layout objects afterwards
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages[start:end]:
+            yield page.extract_text() or ""  # Pages without a text layer return None
+            page.flush_cache()
+
+def extract_page_range(pdf_path, start, end):
+    # Runs in a worker process; a broken file must not take the whole pool down
+    try:
+        return list(iter_pdf_pages(pdf_path, start, end))
+    except Exception as e:
+        print(f"Error extracting pages {start}-{end} of {pdf_path}: {e}")
+        return None
+
+def count_pdf_pages(pdf_path):
+    try:
+        with pdfplumber.open(pdf_path) as pdf:
+            return len(pdf.pages)
+    except Exception as e:
+        print(f"Error opening PDF {pdf_path}: {e}")
+        return None
+
 # Function to extract text using pdfplumber
 def extract_text_from_pdf(pdf_path):
-    text = ""
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            text += page.extract_text()
-    return text
-
-def load_pdf_from_file(cache, file_name, dir_path, school_name):
-    if file_name.endswith(".pdf"):
-        file_path = os.path.join(dir_path, file_name)
-        if file_path in cache['pdfs'] and is_cache_valid(cache['pdfs'][file_path]['timestamp']):
-            print(f"Using cached data for PDF: {file_path}")
-            doc = Document(text=cache['pdfs'][file_path]['content'], 
-                            metadata=cache['pdfs'][file_path]['metadata'])
-            return doc
-        else:
-            print(f"Loading new PDF: {file_path}")
-            extracted_text = extract_text_from_pdf(file_path)
-            doc = Document(text=extracted_text)
-            if school_name:
-                doc.metadata = {"source": file_name, 'type': 'pdf', 'school': school_name.lower()}
-            else:
-                doc.metadata = {"source": file_name, 'type': 'pdf'}
-            cache['pdfs'][file_path] = {'content': doc.text, 
-                                        'timestamp': datetime.now().isoformat(), 
-                                        'metadata': doc.metadata}
-            return doc
-    return None
+    return "\n".join(iter_pdf_pages(pdf_path))
 
-def load_pdfs_from_directory(dir):
-    cache = load_cache()
-    pdf_docs = []
-    
+def get_file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def get_file_hash(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def _pdf_metadata(file_name, school_name):
+    if school_name:
+        return {"source": file_name, 'type': 'pdf', 'school': school_name.lower()}
+    return {"source": file_name, 'type': 'pdf'}
+
+def _cache_pdf(file_path, doc, fingerprint, file_hash):
+    set_cache_entry(PDF_CACHE, file_path, {'content': doc.text,
+                                           'timestamp': datetime.now().isoformat(),
+                                           'metadata': doc.metadata,
+                                           'fingerprint': fingerprint,
+                                           'file_hash': file_hash})
+
+def load_cached_pdf(file_name, dir_path, school_name):
+    # Returns (doc, None) on a cache hit, otherwise (None, (fingerprint, file_hash)) for the extraction step
+    file_path = os.path.join(dir_path, file_name)
+    fingerprint = get_file_fingerprint(file_path)
+    cached = get_cache_entry(PDF_CACHE, file_path)
+    if cached and cached.get('fingerprint') == fingerprint:
+        print(f"Using cached data for PDF: {file_path}")
+        return Document(id_=file_path, text=cached['content'], metadata=cached['metadata']), None
+
+    # Size or mtime changed: only re-extract if the bytes actually changed
+    file_hash = get_file_hash(file_path)
+    if cached and cached.get('file_hash') == file_hash:
+        print(f"Using cached data for PDF (unchanged content): {file_path}")
+        doc = Document(id_=file_path, text=cached['content'], metadata=_pdf_metadata(file_name, school_name))
+        _cache_pdf(file_path, doc, fingerprint, file_hash)
+        return doc, None
+    return None, (fingerprint, file_hash)
+
+def extract_pdfs(file_paths, max_workers=PDF_MAX_WORKERS, pages_per_task=PDF_PAGES_PER_TASK):
+    # Extracts several PDFs in a process pool, splitting large files into page ranges.
+    # Returns the texts in input order, with None for files that could not be read.
+    tasks = []
+    for file_index, file_path in enumerate(file_paths):
+        page_count = count_pdf_pages(file_path)
+        if page_count is None:
+            continue
+        for start in range(0, max(page_count, 1), pages_per_task):
+            tasks.append((file_index, file_path, start, start + pages_per_task))
+
+    if len(tasks) <= 1 or max_workers <= 1:
+        page_ranges = [extract_page_range(file_path, start, end) for _, file_path, start, end in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+            page_ranges = list(executor.map(
+                extract_page_range,
+                [task[1] for task in tasks], [task[2] for task in tasks], [task[3] for task in tasks]))
+
+    pages_by_file = [None for _ in file_paths]
+    failed_files = set()
+    for (file_index, _, _, _), pages in zip(tasks, page_ranges):
+        if pages is None:
+            failed_files.add(file_index)
+            continue
+        if pages_by_file[file_index] is None:
+            pages_by_file[file_index] = []
+        pages_by_file[file_index].extend(pages)
+    return [
+        "\n".join(pages) if pages is not None and file_index not in failed_files else None
+        for file_index, pages in enumerate(pages_by_file)
+    ]
+
+def find_pdf_files(dir):
+    # [(file_name, dir_path, school_name)]; PDFs in a sub folder belong to the school the folder is named after
+    pdf_files = []
     for item in os.listdir(dir):
         item_path = os.path.join(dir, item)
         if os.path.isdir(item_path):
             school_name = item
             for sub_item in os.listdir(item_path):
-                sub_item_doc = load_pdf_from_file(cache, sub_item, item_path, school_name)
-                if sub_item_doc:
-                    pdf_docs.append(sub_item_doc)
+                if sub_item.endswith(".pdf"):
+                    pdf_files.append((sub_item, item_path, school_name))
+        elif item.endswith(".pdf"):
+            pdf_files.append((item, dir, None))
+    return pdf_files
+
+def load_pdfs_from_directory(dir):
+    pdf_files = find_pdf_files(dir)
+    docs = {}
+    to_extract = []
+    for file_name, dir_path, school_name in pdf_files:
+        doc, file_state = load_cached_pdf(file_name, dir_path, school_name)
+        if doc is not None:
+            docs[os.path.join(dir_path, file_name)] = doc
         else:
-            item_doc = load_pdf_from_file(cache, item, dir, None)
-            if item_doc:
-                pdf_docs.append(item_doc)
-                
-    save_cache(cache)
-    return pdf_docs
+            to_extract.append((file_name, dir_path, school_name, file_state))
+
+    if to_extract:
+        file_paths = [os.path.join(dir_path, file_name) for file_name, dir_path, _, _ in to_extract]
+        for file_path in file_paths:
+            print(f"Loading new PDF: {file_path}")
+        extracted_texts = extract_pdfs(file_paths)
+        for (file_name, dir_path, school_name, (fingerprint, file_hash)), file_path, extracted_text in zip(
+                to_extract, file_paths, extracted_texts):
+            if extracted_text is None:
+                print(f"Skipping {file_path} due to extraction failure")
+                continue
+            # The file path is the stable document id, so index refreshes can match PDFs across runs
+            doc = Document(id_=file_path, text=extracted_text, metadata=_pdf_metadata(file_name, school_name))
+            _cache_pdf(file_path, doc, fingerprint, file_hash)
+            docs[file_path] = doc
+
+    return [
+        docs[os.path.join(dir_path, file_name)]
+        for file_name, dir_path, _ in pdf_files
+        if os.path.join(dir_path, file_name) in docs
+    ]
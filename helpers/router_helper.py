@@ -0,0 +1,114 @@
+import random
+import re
+from collections import Counter
+from config.config_app import RAG_ROUTER_MODE, RAG_ROUTER_AGREEMENT_SAMPLE_RATE, RAG_MAX_CONCURRENT_QUERIES
+
+# Messages made up entirely of small talk never need school data ("thanks!", "ok great")
+SMALL_TALK_PATTERN = re.compile(
+    r"^\W*((hi|hello|hey|thanks|thank you|thx|ok|okay|great|cool|nice|awesome|perfect|got it|bye|goodbye|"
+    r"good (morning|afternoon|evening))\W*)+$", re.IGNORECASE)
+
+# A question that stands on its own ("What is the tuition at Harker?", "Tell me about Pinewood school")
+FULL_QUESTION_PATTERN = re.compile(
+    r"^\W*(what|when|where|who|which|why|how|does|do|is|are|can|could|will|tell me about|describe)\b",
+    re.IGNORECASE)
+FULL_QUESTION_MIN_WORDS = 4
+SHORT_FOLLOW_UP_MAX_WORDS = 4  # Once the conversation has started, messages this short lean on earlier turns
+
+# Questions the school data can answer
+SCHOOL_INFO_PATTERN = re.compile(
+    r"\b(tuition|fees?|cost|admissions?|apply|application|deadlines?|enrol\w*|curriculum|academics?|programs?|"
+    r"class(es)? size|ratio|teachers?|faculty|staff|sports|athletics|after ?school|aftercare|extended care|calendar|"
+    r"schedule|hours|start time|uniforms?|lunch|bus|transportation|financial aid|scholarships?|grades?|campus|"
+    r"facilities|events?|open house|tours?|languages?|stem|arts?|music|philosophy|values|mission|accredit\w*)\b",
+    re.IGNORECASE)
+
+# Travel questions are answered by the map functions, but the LLM router may still fetch addresses for them
+TRAVEL_PATTERN = re.compile(
+    r"\b(drive|driving|commute|travel|traffic|how far|distance|get there|minutes away|transit|walk|arrive|leave)\b",
+    re.IGNORECASE)
+
+# References to earlier turns ("What about Pinewood?", "And Keys?", "tell me more"), which only the LLM can
+# turn into a complete RAG question
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(they|their|them|it|its|there|that school|this school|these schools|those schools|both|each|either|"
+    r"others?|other ones?|same|what about|how about|tell me more|what else|anything else)\b|^\W*and\b",
+    re.IGNORECASE)
+
+
+class RagRouter:
+    """Decides locally whether a message needs RAG and for which schools, deferring to the LLM when unsure.
+
+    route() returns {'route': 'none' | 'rag' | 'llm', 'rag_messages': [...], 'reason': str}.
+    """
+
+    def __init__(self, school_resolver, mode=RAG_ROUTER_MODE, sample_rate=RAG_ROUTER_AGREEMENT_SAMPLE_RATE,
+                 max_schools=RAG_MAX_CONCURRENT_QUERIES):
+        self.school_resolver = school_resolver
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.max_schools = max_schools
+        self.decisions = Counter()
+        self.comparisons = 0
+        self.agreements = 0
+
+    def route(self, message, has_history=False):
+        # has_history: whether earlier turns exist that a short message could be building on
+        schools = self.school_resolver.find_schools(message)
+        has_school_info = bool(SCHOOL_INFO_PATTERN.search(message))
+        word_count = len(message.split())
+        is_full_question = bool(FULL_QUESTION_PATTERN.search(message)) and word_count >= FULL_QUESTION_MIN_WORDS
+
+        if SMALL_TALK_PATTERN.search(message):
+            decision = self._decision('none', reason="small talk")
+        elif not schools:
+            # Possibly a follow-up about a school named earlier in the conversation
+            decision = self._decision('llm', reason="no school mentioned")
+        elif FOLLOW_UP_PATTERN.search(message):
+            decision = self._decision('llm', reason="refers to earlier turns")
+        elif has_history and word_count <= SHORT_FOLLOW_UP_MAX_WORDS:
+            decision = self._decision('llm', reason="short follow-up")
+        elif TRAVEL_PATTERN.search(message) and not has_school_info:
+            decision = self._decision('llm', reason="travel question")
+        elif not (has_school_info or is_full_question):
+            decision = self._decision('llm', reason="no complete question")
+        elif len(schools) > self.max_schools:
+            decision = self._decision('llm', reason="too many schools")
+        else:
+            # The retriever filters by school, so each school gets the user's question as-is
+            rag_messages = [{"question": message, "school": school} for school in schools]
+            decision = self._decision('rag', rag_messages, reason=f"mentions {', '.join(schools)}")
+
+        self.decisions[decision['route']] += 1
+        total = sum(self.decisions.values())
+        print(f"RAG router: {decision['route']} ({decision['reason']}); "
+              f"{total - self.decisions['llm']}/{total} decided locally")
+        return decision
+
+    def _decision(self, route, rag_messages=None, reason=""):
+        return {'route': route, 'rag_messages': rag_messages or [], 'reason': reason}
+
+    def use_llm(self, decision):
+        if self.mode != "on" or decision['route'] == 'llm':
+            return True
+        # Re-check a sample of confident decisions against the LLM router
+        return random.random() < self.sample_rate
+
+    def record_llm_result(self, decision, llm_rag_messages):
+        # Compares a confident local decision with the LLM router's: same fetch decision and same schools
+        if self.mode == "off" or decision['route'] == 'llm':
+            return
+        local_schools = {item['school'] for item in decision['rag_messages']}
+        llm_schools = {
+            self.school_resolver.resolve(item.get('school', '')) or item.get('school', '')
+            for item in llm_rag_messages
+        }
+        agreed = local_schools == llm_schools
+
+        self.comparisons += 1
+        if agreed:
+            self.agreements += 1
+        else:
+            print(f"RAG router disagreement: local {sorted(local_schools)} vs LLM {sorted(llm_schools)}")
+        print(f"RAG router agreement: {self.agreements}/{self.comparisons} "
+              f"({self.agreements / self.comparisons:.0%})")
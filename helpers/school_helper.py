@@ -0,0 +1,216 @@
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from urllib.parse import urlparse
+
+# Words that do not identify a school ("The Harker School", "Harker lower campus" -> "harker")
+STOP_WORDS = {
+    'the', 'a', 'an', 'of', 'and', 'at', 'in', 'for',
+    'school', 'schools', 'campus', 'campuses',
+    'lower', 'middle', 'upper', 'elementary', 'kindergarten', 'preschool',
+}
+
+# Link hosts shared by many schools, which must never become a school alias
+AGGREGATOR_DOMAINS = {
+    'niche.com', 'yelp.com', 'greatschools.org', 'privateschoolreview.com',
+    'google.com', 'facebook.com', 'instagram.com', 'youtube.com', 'linkedin.com',
+}
+
+# Words that change which facts a question asks about ("tuition for kindergarten" vs "tuition for 9th grade")
+NUMBER_WORDS = {
+    'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5', 'six': '6',
+    'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10', 'eleven': '11', 'twelve': '12',
+    'first': '1', 'second': '2', 'third': '3', 'fourth': '4', 'fifth': '5', 'sixth': '6',
+    'seventh': '7', 'eighth': '8', 'ninth': '9', 'tenth': '10', 'eleventh': '11', 'twelfth': '12',
+}
+GRADE_WORDS = {
+    'k': 'kindergarten', 'kindergarten': 'kindergarten', 'kindergarden': 'kindergarten', 'tk': 'tk',
+    'preschool': 'preschool', 'prek': 'preschool', 'elementary': 'elementary', 'lower': 'lower',
+    'middle': 'middle', 'upper': 'upper', 'high': 'high', 'freshman': '9', 'sophomore': '10',
+    'junior': '11', 'senior': '12',
+}
+
+TOKEN_MATCH_THRESHOLD = 0.5  # Share of an alias' tokens the mention must name; extra mention tokens never match
+TRIGRAM_MATCH_THRESHOLD = 0.6  # Dice coefficient for the typo-tolerant fallback
+RESOLVE_CACHE_SIZE = 1024
+
+
+def _stem(token):
+    # Crude plural folding so "Khan Labs" and "Khan Lab School" share tokens
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+def exact_tokens(text):
+    tokens = re.findall(r'[a-z0-9]+', text.lower())
+    return [token for token in tokens if token not in STOP_WORDS]
+
+def normalize_tokens(text):
+    return [_stem(token) for token in exact_tokens(text)]
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _domain_alias(url):
+    host = urlparse(url).netloc.lower().split(':')[0]
+    if host.startswith('www.'):
+        host = host[4:]
+    if not host or host in AGGREGATOR_DOMAINS:
+        return None
+    # "harker.org" -> "harker", "lower.keysschool.org" -> "keysschool"
+    labels = host.split('.')
+    return labels[-2] if len(labels) >= 2 else labels[0]
+
+def _school_urls(school):
+    for key, data in school.items():
+        if key == 'name':
+            continue
+        if isinstance(data, list):
+            yield from data
+        elif isinstance(data, str):
+            yield data
+
+def query_qualifiers(text):
+    # Numbers and grade levels in a question; similar questions that differ in these have different answers
+    text = re.sub(r'\bpre-k\b', 'prek', text.lower())
+    qualifiers = set()
+    for token in re.findall(r'[a-z0-9]+', text):
+        number = re.fullmatch(r'(\d+)(st|nd|rd|th)?', token)
+        if number:
+            qualifiers.add(number.group(1))
+        elif token in NUMBER_WORDS:
+            qualifiers.add(NUMBER_WORDS[token])
+        elif token in GRADE_WORDS:
+            qualifiers.add(GRADE_WORDS[token])
+    return frozenset(qualifiers)
+
+
+class SchoolResolver:
+    """Maps free-text school mentions to canonical school ids using indexes built once."""
+
+    def __init__(self, school_links, pdf_dir=None):
+        self._aliases = {}  # normalized alias -> school id
+        self._alias_tokens = {}  # normalized alias -> token set
+        self._token_index = {}  # token -> normalized aliases containing it
+        self._trigram_index = {}  # trigram -> compact aliases containing it
+        self._compact_aliases = {}  # alias with spaces removed -> school id
+        self._exact_aliases = {}  # unstemmed alias, with and without spaces -> school id
+        self._max_alias_tokens = 1
+        self.school_ids = []
+
+        for school in school_links:
+            school_id = school['name'].lower()
+            self._add_school(school_id)
+            self._add_alias(school['name'], school_id)
+
+            # Prefer the root domain, otherwise the school's most common own domain
+            if 'root' in school:
+                domain = _domain_alias(school['root'])
+            else:
+                domains = Counter(filter(None, (_domain_alias(url) for url in _school_urls(school))))
+                domain = domains.most_common(1)[0][0] if domains else None
+            if domain:
+                self._add_alias(domain, school_id)
+
+        # PDF folders in private_data are named after schools
+        if pdf_dir and os.path.isdir(pdf_dir):
+            for item in sorted(os.listdir(pdf_dir)):
+                if os.path.isdir(os.path.join(pdf_dir, item)):
+                    school_id = self._resolve(item)
+                    if school_id is None:
+                        school_id = item.lower()
+                        self._add_school(school_id)
+                    self._add_alias(item, school_id)
+
+        self.resolve = lru_cache(maxsize=RESOLVE_CACHE_SIZE)(self._resolve)
+
+    def _add_school(self, school_id):
+        if school_id not in self.school_ids:
+            self.school_ids.append(school_id)
+
+    def _add_alias(self, alias, school_id):
+        tokens = normalize_tokens(alias)
+        if not tokens:
+            return
+        key = ' '.join(tokens)
+        self._aliases.setdefault(key, school_id)
+        self._max_alias_tokens = max(self._max_alias_tokens, len(tokens))
+        self._alias_tokens[key] = set(tokens)
+        for token in tokens:
+            self._token_index.setdefault(token, set()).add(key)
+
+        compact = ''.join(tokens)
+        self._compact_aliases.setdefault(compact, school_id)
+        for trigram in _trigrams(compact):
+            self._trigram_index.setdefault(trigram, set()).add(compact)
+
+        # Unstemmed, so "Keys School" is found as "keys" but not in "key differences"
+        exact = exact_tokens(alias)
+        self._exact_aliases.setdefault(' '.join(exact), school_id)
+        self._exact_aliases.setdefault(''.join(exact), school_id)
+
+    def find_schools(self, text):
+        # Scans the text for exact alias n-grams, longest first: "is harker closer than keys" -> both schools.
+        # Only exact mentions count: stemming and fuzzy matching are left to resolve(), since in free text they
+        # would match ordinary words ("key" for Keys School).
+        tokens = exact_tokens(text)
+        found = []
+        i = 0
+        while i < len(tokens):
+            for n in range(min(self._max_alias_tokens, len(tokens) - i), 0, -1):
+                gram = tokens[i:i + n]
+                school_id = self._exact_aliases.get(' '.join(gram)) or self._exact_aliases.get(''.join(gram))
+                if school_id:
+                    if school_id not in found:
+                        found.append(school_id)
+                    i += n
+                    break
+            else:
+                i += 1
+        return found
+
+    def _resolve(self, mention):
+        if not mention:
+            return None
+        tokens = normalize_tokens(mention)
+        if not tokens:
+            return None
+
+        key = ' '.join(tokens)
+        if key in self._aliases:
+            return self._aliases[key]
+        compact = ''.join(tokens)
+        if compact in self._compact_aliases:
+            return self._compact_aliases[compact]
+
+        # Token containment: the share of the alias the mention names. A mention with tokens of its own names
+        # another school ("Khan Academy" is not "Khan Lab"), so only aliases containing every mention token score.
+        mention_tokens = set(tokens)
+        best_score, best_ids = 0.0, set()
+        for alias in set().union(*(self._token_index.get(token, set()) for token in mention_tokens)):
+            alias_tokens = self._alias_tokens[alias]
+            if not mention_tokens <= alias_tokens:
+                continue
+            score = len(mention_tokens) / len(alias_tokens)
+            if score > best_score:
+                best_score, best_ids = score, {self._aliases[alias]}
+            elif score == best_score:
+                best_ids.add(self._aliases[alias])
+        if best_score >= TOKEN_MATCH_THRESHOLD and len(best_ids) == 1:
+            return best_ids.pop()
+
+        # Trigram fallback for typos ("harkr", "pinewod")
+        mention_trigrams = _trigrams(compact)
+        candidates = Counter()
+        for trigram in mention_trigrams:
+            candidates.update(self._trigram_index.get(trigram, ()))
+        best_score, best_id = 0.0, None
+        for alias, shared in candidates.items():
+            score = 2 * shared / (len(mention_trigrams) + len(_trigrams(alias)))
+            if score > best_score:
+                best_score, best_id = score, self._compact_aliases[alias]
+        if best_score >= TRIGRAM_MATCH_THRESHOLD:
+            return best_id
+        return None
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from config.config_app import STREAM_FLUSH_INTERVAL_SECONDS, STREAM_FLUSH_CHARS
+
+
+class TokenStreamer:
+    """Coalesces streamed LLM deltas into larger frames sent to a Chainlit message.
+
+    Buffered text is flushed once it reaches max_chars, or window_seconds after the first buffered delta,
+    so a session sends a few frames per second instead of one websocket frame per token.
+    """
+
+    def __init__(self, message, window_seconds=STREAM_FLUSH_INTERVAL_SECONDS, max_chars=STREAM_FLUSH_CHARS):
+        self.message = message
+        self.window_seconds = window_seconds
+        self.max_chars = max_chars
+        self._parts = []  # Everything streamed so far, joined once at the end
+        self._pending = []  # Deltas not sent yet
+        self._pending_chars = 0
+        self._pending_since = None
+        self._timer = None
+        self._flush_lock = asyncio.Lock()  # Keeps frames in order when a timer flush overlaps a size flush
+        self._timer_tasks = set()
+        self.deltas_received = 0
+        self.frames_sent = 0
+        self._flush_latencies = []
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    async def push(self, text):
+        if not text:
+            return
+        self.deltas_received += 1
+        self._parts.append(text)
+        self._pending.append(text)
+        self._pending_chars += len(text)
+        if self._pending_since is None:
+            self._pending_since = time.perf_counter()
+            # Flush on time even if the model pauses before the next delta
+            self._timer = asyncio.get_running_loop().call_later(self.window_seconds, self._flush_on_timer)
+
+        if self._pending_chars >= self.max_chars:
+            await self.flush()
+
+    def _flush_on_timer(self):
+        task = asyncio.ensure_future(self.flush())
+        self._timer_tasks.add(task)
+        task.add_done_callback(self._timer_tasks.discard)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            frame = "".join(self._pending)
+            latency = time.perf_counter() - self._pending_since
+            self._pending = []
+            self._pending_chars = 0
+            self._pending_since = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            await self.message.stream_token(frame)
+            self.frames_sent += 1
+            self._flush_latencies.append(latency)
+
+    async def close(self):
+        # Sends whatever is still buffered; call once the LLM stream has ended
+        await self.flush()
+        if self._timer_tasks:
+            await asyncio.gather(*self._timer_tasks)
+
+    def stats(self):
+        latencies = self._flush_latencies
+        return {
+            'deltas': self.deltas_received,
+            'frames': self.frames_sent,
+            'avg_flush_latency_ms': 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+            'max_flush_latency_ms': 1000 * max(latencies) if latencies else 0.0,
+        }
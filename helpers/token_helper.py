@@ -0,0 +1,31 @@
+import tiktoken
+from config.config_llm import config
+
+_encoding = None
+
+def get_encoding():
+    # Loading may download the encoding file, so the app calls this at startup rather than on the event loop
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(config["model"])
+        except Exception as e:
+            # Unknown model, or the encoding file could not be downloaded: fall back to an estimate
+            print(f"Token encoding unavailable, estimating token counts: {e}")
+            _encoding = False
+    return _encoding
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * 4]
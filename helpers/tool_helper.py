@@ -0,0 +1,158 @@
+import asyncio
+import inspect
+import json
+import time
+from config.config_app import TOOL_TIMEOUT_SECONDS, TOOL_MAX_CONCURRENCY
+
+
+def tool_error(name, error, message):
+    # Errors are returned to the model as structured results rather than raised
+    return json.dumps({"error": error, "tool": name, "message": message})
+
+
+class ToolRegistry:
+    """Maps tool names to async handlers, with the schema the LLM sees, a timeout and a concurrency limit."""
+
+    def __init__(self, schemas):
+        self._schemas = {schema["function"]["name"]: schema for schema in schemas}
+        self._tools = {}  # name -> {'handler', 'schema', 'timeout', 'semaphore', 'tooltip', 'batched'}
+        self._stats = {}  # name -> {'calls', 'errors', 'timeouts', 'total_latency', 'max_latency'}
+
+    def register(self, name, handler, timeout=TOOL_TIMEOUT_SECONDS, max_concurrency=TOOL_MAX_CONCURRENCY,
+                 tooltip=None, batched=False):
+        # batched: the handler merges calls made close together, so its calls are started together at the end
+        # of the stream rather than one by one while it streams
+        if name not in self._schemas:
+            raise ValueError(f"No schema for tool '{name}'")
+        self._tools[name] = {
+            'handler': handler,
+            'schema': self._schemas[name],
+            'timeout': timeout,
+            'semaphore': asyncio.Semaphore(max_concurrency),
+            'tooltip': tooltip,
+            'batched': batched,
+        }
+        self._stats[name] = {'calls': 0, 'errors': 0, 'timeouts': 0, 'total_latency': 0.0, 'max_latency': 0.0}
+
+    def schemas(self):
+        # Only registered tools are offered to the model
+        return [tool['schema'] for tool in self._tools.values()]
+
+    def tooltip(self, name):
+        tool = self._tools.get(name)
+        return tool['tooltip'] if tool else None
+
+    def is_batched(self, name):
+        tool = self._tools.get(name)
+        return tool['batched'] if tool else False
+
+    def parse_arguments(self, arguments):
+        if isinstance(arguments, dict):
+            return arguments
+        parsed = json.loads(arguments or "{}")
+        if not isinstance(parsed, dict):
+            raise ValueError("Arguments must be a JSON object")
+        return parsed
+
+    async def call(self, name, arguments):
+        tool = self._tools.get(name)
+        if tool is None:
+            return tool_error(name, "unknown_tool", f"There is no tool named '{name}'")
+        try:
+            kwargs = self.parse_arguments(arguments)
+        except ValueError as e:
+            return tool_error(name, "invalid_arguments", f"Could not parse the arguments: {e}")
+        try:
+            # Checked up front, so a TypeError raised inside the handler is reported as a failure instead
+            inspect.signature(tool['handler']).bind(**kwargs)
+        except TypeError as e:
+            return tool_error(name, "invalid_arguments", str(e))
+
+        print(f"Calling tool {name} with {kwargs}")
+        stats = self._stats[name]
+        stats['calls'] += 1
+        start_time = time.perf_counter()
+        try:
+            async with tool['semaphore']:
+                return await asyncio.wait_for(tool['handler'](**kwargs), tool['timeout'])
+        except asyncio.TimeoutError:
+            stats['timeouts'] += 1
+            return tool_error(name, "timeout", f"The tool did not respond within {tool['timeout']} seconds")
+        except Exception as e:
+            stats['errors'] += 1
+            print(f"Tool {name} failed: {e}")
+            return tool_error(name, "tool_failed", str(e))
+        finally:
+            latency = time.perf_counter() - start_time
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            print(f"Tool {name} took {latency:.2f}s")
+
+    def stats(self):
+        return {
+            name: {**stats, 'avg_latency': stats['total_latency'] / stats['calls'] if stats['calls'] else 0.0}
+            for name, stats in self._stats.items()
+        }
+
+
+class ToolCallCollector:
+    """Assembles streamed tool call deltas and starts each call through the registry as soon as it is complete.
+
+    A call is complete once its arguments parse as a JSON object, or when the model starts the next call,
+    so external API latency overlaps with the rest of the model output. Calls still open when the stream
+    ends, and all calls to batched tools, are started together by finish().
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._calls = {}  # tool call index -> {'name', 'arguments' (list of chunks), 'task'}
+        self.started_during_stream = 0
+
+    def add(self, tool_call_deltas):
+        for delta in tool_call_deltas:
+            call = self._calls.get(delta.index)
+            if call is None:
+                # The model moved on to a new call, so the earlier ones are complete
+                for previous_call in self._calls.values():
+                    self._start(previous_call, during_stream=True)
+                call = self._calls[delta.index] = {'name': "", 'arguments': [], 'task': None}
+            if delta.function is None:
+                continue
+            if delta.function.name:
+                call['name'] += delta.function.name
+            if delta.function.arguments:
+                call['arguments'].append(delta.function.arguments)
+                # Only try to parse when an object may have just closed
+                if '}' in delta.function.arguments and self._arguments_complete(call):
+                    self._start(call, during_stream=True)
+
+    def _arguments_complete(self, call):
+        try:
+            return isinstance(json.loads("".join(call['arguments'])), dict)
+        except ValueError:
+            return False
+
+    def _start(self, call, during_stream=False):
+        if call['task'] is not None or not call['name']:
+            return
+        if during_stream and self.registry.is_batched(call['name']):
+            # Streamed calls finish too far apart to share a batch, so they wait for the end of the stream
+            return
+        call['task'] = asyncio.create_task(self.registry.call(call['name'], "".join(call['arguments'])))
+        if during_stream:
+            self.started_during_stream += 1
+
+    def finish(self):
+        # Returns the started calls in call order as [{'name', 'arguments', 'task'}]
+        for call in self._calls.values():
+            self._start(call)
+        return [
+            {'name': call['name'], 'arguments': "".join(call['arguments']), 'task': call['task']}
+            for _, call in sorted(self._calls.items())
+            if call['task'] is not None
+        ]
+
+    def cancel(self):
+        for call in self._calls.values():
+            if call['task'] is not None and not call['task'].done():
+                call['task'].cancel()
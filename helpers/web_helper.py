@@ -1,17 +1,19 @@
 from dotenv import load_dotenv
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from urllib.parse import urlparse
 from llama_index.core import Document
 from datetime import datetime
-from helpers.cache_helper import load_cache, save_cache, is_cache_valid
-from helpers.cache_helper import load_scraper_cache, save_scraper_cache
+from helpers.cache_helper import get_cache_entry, set_cache_entry, is_cache_valid, get_cache_expiry_days
+from helpers.cache_helper import WEBSITE_CACHE, SCRAPER_CACHE
+from helpers.fetch_helper import Crawler, fetch_urls
+from config.config_app import FETCH_MAX_RETRIES
 
+import asyncio
+
+import hashlib
 import requests
 import re
 import time
-import random
 
 # Load environment variables
 load_dotenv()
@@ -51,215 +53,239 @@ def clean_and_preprocess_website(website_document):
     cleaned_text = clean_and_preprocess_website_text(website_document.text)
     return Document(text=cleaned_text, metadata=website_document.metadata)
 
-def create_session_with_retries():
-    session = requests.Session()
-    retries = Retry(total=3,
-                    backoff_factor=0.1,
-                    status_forcelist=[500, 502, 503, 504])
-    session.mount('http://', HTTPAdapter(max_retries=retries))
-    session.mount('https://', HTTPAdapter(max_retries=retries))
-    return session
+def extract_text_from_html(html):
+    # Parse the HTML content
+    soup = BeautifulSoup(html, 'html.parser')
+    
+    # Extract text content
+    return soup.get_text(separator='\n', strip=True)
 
 class CustomWebPageReader:
-    def __init__(self):
-        self.session = create_session_with_retries()
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Referer': 'https://www.google.com/'
-        }
+    def __init__(self, max_retries=FETCH_MAX_RETRIES):
+        self.max_retries = max_retries
+        self.last_report = []
+
+    def fetch_pages(self, urls, validators=None):
+        # Fetch all URLs concurrently; a slow or rate-limited host only delays its own pages
+        start_time = time.perf_counter()
+        results = asyncio.run(fetch_urls(urls, max_retries=self.max_retries, validators=validators))
+        self.last_report = results
+
+        for result in results:
+            if result['not_modified']:
+                outcome = "not modified"
+            elif result['text'] is not None:
+                outcome = "ok"
+            else:
+                outcome = f"failed ({result['error']})"
+            print(f"Fetched {result['url']}: {outcome} in {result['latency']:.2f}s, {result['attempts']} attempt(s)")
+
+        failed = sum(1 for result in results if result['error'] is not None)
+        print(f"Fetched {len(results)} pages in {time.perf_counter() - start_time:.2f}s ({failed} failed)")
+        return results
 
     def load_data(self, urls):
         documents = []
-        for url in urls:
-            try:
-                response = self.session.get(url, headers=self.headers, timeout=30)
-                response.raise_for_status()
-                html = response.text
-                
-                # Parse the HTML content
-                soup = BeautifulSoup(html, 'html.parser')
-                
-                # Extract text content
-                text = soup.get_text(separator='\n', strip=True)
-                
-                documents.append(Document(text=text, extra_info={"url": url}))
-            except requests.RequestException as e:
-                print(f"Error fetching {url}: {str(e)}")
+        for result in self.fetch_pages(urls):
+            if result['text'] is not None:
+                text = extract_text_from_html(result['text'])
+                documents.append(Document(text=text, extra_info={"url": result['url']}))
         return documents
 
-def load_document_from_url(loader, url, max_retries=2, retry_count=0):
-    print(f"Loading web data from: {url} (Attempt {retry_count + 1})")
+def _content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _cache_website(link, doc, content_hash, validators=None):
+    validators = validators or {}
+    set_cache_entry(WEBSITE_CACHE, link, {
+        'content': doc.text,
+        'timestamp': datetime.now().isoformat(),
+        'metadata': doc.metadata,
+        'content_hash': content_hash,
+        'etag': validators.get('etag'),
+        'last_modified': validators.get('last_modified'),
+    })
+
+def build_website_document(link, raw_doc, school_name=None, validators=None):
+    # Shared by page loads and the crawler: clean the text, tag the metadata and cache the result
+    content_hash = _content_hash(raw_doc.text)
+    cached = get_cache_entry(WEBSITE_CACHE, link)
+    if cached and cached.get('content_hash') == content_hash:
+        # Same extracted text as last time, so the cleaned text in the cache is still correct
+        print(f"Unchanged content for website: {link}")
+        doc = Document(text=cached['content'], metadata=cached['metadata'])
+    else:
+        doc = clean_and_preprocess_website(raw_doc)
     
-    try:
-        docs = loader.load_data(urls=[url])
-        
-        if len(docs) == 0:
-            print(f"No data found for {url}")
-            return None
-        elif len(docs) > 1:
-            print(f"Loaded {len(docs)} documents from {url} -> i.e more than one document")
-        
-        return docs[0]
+    if doc.metadata is None:
+        doc.metadata = {}
     
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 404:
-            print(f"Page not found (404) for {url}")
-            return None
-        elif e.response.status_code == 403:
-            if retry_count < max_retries:
-                print(f"Received 403 Forbidden. Waiting and retrying... (Attempt {retry_count + 2})")
-                time.sleep(random.uniform(5, 10))  # Wait for 5-10 seconds
-                return load_document_from_url(loader, url, max_retries, retry_count + 1)  # Retry
-            else:
-                print(f"Max retries reached for {url}. Giving up.")
+    # Update metadata
+    doc.metadata.update({
+        "source": link,
+        "type": "website"
+    })
+
+    if school_name:
+        doc.metadata['school'] = school_name.lower()
+
+    # The URL is the stable document id, so index refreshes can match pages across runs
+    doc.id_ = link
+    _cache_website(link, doc, content_hash, validators)
+    return doc
+
+
+def load_links(link_schools):
+    # link_schools: [(link, school_name)]; cached pages are reused and the rest are fetched in one pool
+    docs_by_link = {}
+    to_fetch = {}
+    stale_entries = {}
+    for link, school_name in link_schools:
+        cached = get_cache_entry(WEBSITE_CACHE, link)
+        if cached and is_cache_valid(cached['timestamp'], get_cache_expiry_days(link)):
+            print(f"Using cached data for website: {link}")
+            docs_by_link[link] = Document(id_=link, text=cached['content'], 
+                                          metadata=cached['metadata'])
         else:
-            print(f"HTTP error occurred: {e}")
-        return None
-    except Exception as e:
-        print(f"Error loading {url}: {str(e)}")
-        return None
-
-
-def load_link(link, loader, cache, school_name=None):
-    doc = None
-    if link in cache['websites'] and is_cache_valid(cache['websites'][link]['timestamp']):
-        print(f"Using cached data for website: {link}")
-        doc = Document(text=cache['websites'][link]['content'], 
-                        metadata=cache['websites'][link]['metadata'])
-    else:
-        print(f"Loading new website: {link}")
-        doc = load_document_from_url(loader, link)
-        
-        if doc is None:
-            print(f"Failed to load document from {link}")
-            return None, cache  # Return None if we couldn't load the document
-        
-        # print("doc: " + str(doc))
-        doc = clean_and_preprocess_website(doc)
-        
-        if doc.metadata is None:
-            doc.metadata = {}
-        
-        # Update metadata
-        doc.metadata.update({
-            "source": link,
-            "type": "website"
-        })
-
-        if school_name:
-            doc.metadata['school'] = school_name.lower()
-
-        cache['websites'][link] = {
-            'content': doc.text,
-            'timestamp': datetime.now().isoformat(),
-            'metadata': doc.metadata
+            print(f"Loading new website: {link}")
+            to_fetch[link] = school_name
+            if cached:
+                stale_entries[link] = cached
+
+    if to_fetch:
+        loader = CustomWebPageReader()
+        # Stale pages are revalidated with their ETag / Last-Modified instead of being downloaded blindly
+        validators = {
+            link: {'etag': cached.get('etag'), 'last_modified': cached.get('last_modified')}
+            for link, cached in stale_entries.items()
         }
-    
-    return doc, cache
-        
+        for result in loader.fetch_pages(list(to_fetch), validators):
+            link = result['url']
+            if result['not_modified'] and link in stale_entries:
+                cached = stale_entries[link]
+                doc = Document(id_=link, text=cached['content'], metadata=cached['metadata'])
+                _cache_website(link, doc, cached.get('content_hash'), result)
+                docs_by_link[link] = doc
+            elif result['text'] is not None:
+                raw_doc = Document(text=extract_text_from_html(result['text']), extra_info={"url": link})
+                docs_by_link[link] = build_website_document(link, raw_doc, to_fetch[link], result)
+            elif link in stale_entries:
+                # A failed fetch (outage, 404) must not drop the page: keep serving the last good copy
+                print(f"Fetch failed, using stale cached data for website: {link}")
+                cached = stale_entries[link]
+                docs_by_link[link] = Document(id_=link, text=cached['content'], metadata=cached['metadata'])
 
-def load_school_links(links, school_name = None):
     web_docs = []
-    loader = CustomWebPageReader()
-    cache = load_cache()
-        
-    for link in links:
-        doc, cache = load_link(link, loader, cache, school_name)
-        if doc is not None:
-            web_docs.append(doc)
+    for link, _ in link_schools:
+        if link in docs_by_link:
+            web_docs.append(docs_by_link[link])
         else:
             print(f"Skipping {link} due to loading failure")
-        
-    save_cache(cache)
     return web_docs
+        
 
+def load_school_links(links, school_name = None):
+    return load_links([(link, school_name) for link in links])
 
-def load_non_root_links(school_links):
-    docs = []
+
+def get_listed_links(school_links):
+    # [(link, school_name)] for every page listed in the links file, other than the crawl roots
+    link_schools = []
     for school in school_links:
         school_name = school['name']
-        links = []
         for key, data in school.items():
             # print("key: " + key)
             if key not in ['name', 'additional_links', 'root']:
-                links.append(data)
+                link_schools.append((data, school_name))
             elif key == 'additional_links':
                 for link in data:
-                    links.append(link)
-        returned_docs = load_school_links(links, school_name)
-        docs.extend(returned_docs)
-    return docs
+                    link_schools.append((link, school_name))
+    return link_schools
 
 
-def crawl_links(root_link, max_pages = 100):
-    links = []
-    
-    root_domain = urlparse(root_link).netloc
-    cache = load_scraper_cache()
-    cache_key = f"{root_domain}_{max_pages}"
-    
-    if cache_key in cache and is_cache_valid(cache[cache_key]['timestamp']):
-        print(f"Using cached data for root link: {root_link}: found {len(cache[cache_key]['links'])} links")
-        return cache[cache_key]['links']
-    
-    to_visit = [root_link]
-    visited = set()
-    
-    session = requests.Session()
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Referer': 'https://www.google.com'
-    }
-    
-    while len(to_visit) > 0 and len(links) < max_pages:
-        url = to_visit.pop(0)
-        if url in visited:
-            continue
-        
-        links.append(url)
-
-        try:
-            print(f"Scraping {url}")
-            response = session.get(url, headers=headers, timeout=10)
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Find new links
-                for link in soup.find_all('a', href=True):
-                    new_url = urljoin(url, link['href'])
-                    # print("new_url: " + new_url)
-                    if is_relevant_to_root_url(new_url, root_domain) and new_url not in visited:
-                        to_visit.append(new_url)
-            else:
-                print(f"Skipping {url} because it returned status code {response.status_code}")
+def load_non_root_links(school_links):
+    # Links of all schools are loaded together so they share one concurrent fetch pool
+    return load_links(get_listed_links(school_links))
 
-            visited.add(url)
 
-        except Exception as e:
-            print(f"Error scraping {url}: {str(e)}")
-    
-    # Update cache with new results
-    cache[cache_key] = {
-        'links': links,
-        'timestamp': datetime.now().isoformat()
-    }
-    save_scraper_cache(cache)
+def _crawl(root_links, max_pages, page_handler=None):
+    # Cached crawls are reused; the remaining sites are crawled concurrently over one connection pool
+    crawled_links = {}
+    to_crawl = []
+    for root_link in root_links:
+        cache_key = f"{urlparse(root_link).netloc}_{max_pages}"
+        cached = get_cache_entry(SCRAPER_CACHE, cache_key)
+        if cached and is_cache_valid(cached['timestamp']):
+            print(f"Using cached data for root link: {root_link}: found {len(cached['links'])} links")
+            crawled_links[root_link] = cached['links']
+        else:
+            to_crawl.append(root_link)
+
+    if to_crawl:
+        crawler = Crawler(is_relevant_to_root_url, max_pages=max_pages, page_handler=page_handler)
+        for root_link, links in asyncio.run(crawler.crawl(to_crawl)).items():
+            cached = get_cache_entry(SCRAPER_CACHE, f"{urlparse(root_link).netloc}_{max_pages}")
+            if len(links) <= 1 and cached and len(cached['links']) > len(links):
+                # The crawl never got past the root page (site down): keep the last known page list
+                print(f"Crawl of {root_link} found no pages, using stale cached links")
+                crawled_links[root_link] = cached['links']
+                continue
+            # Update cache with new results
+            set_cache_entry(SCRAPER_CACHE, f"{urlparse(root_link).netloc}_{max_pages}", {
+                'links': links,
+                'timestamp': datetime.now().isoformat()
+            })
+            crawled_links[root_link] = links
+
+    return crawled_links, set(to_crawl)
+
+
+def get_crawled_links(root_links, max_pages = 100):
+    # Last known crawl results, even if expired; never crawls
+    crawled_links = {}
+    for root_link in root_links:
+        cached = get_cache_entry(SCRAPER_CACHE, f"{urlparse(root_link).netloc}_{max_pages}")
+        crawled_links[root_link] = cached['links'] if cached else []
+    return crawled_links
+
 
-    return links
+def crawl_all_links(root_links, max_pages = 100):
+    crawled_links, _ = _crawl(root_links, max_pages)
+    return crawled_links
 
 
-def load_crawled_links(school_links):
+def crawl_links(root_link, max_pages = 100):
+    return crawl_all_links([root_link], max_pages)[root_link]
+
+
+def load_crawled_links(school_links, max_pages = 100):
     crawled_docs = []
+    root_school_names = {school['root']: school['name'] for school in school_links if 'root' in school}
+    fetched_docs = {root_link: [] for root_link in root_school_names}
+
+    def ingest_page(url, root_link, html):
+        # Pages downloaded by the crawler go straight into the document pipeline instead of being fetched again
+        raw_doc = Document(text=extract_text_from_html(html), extra_info={"url": url})
+        fetched_docs[root_link].append(build_website_document(url, raw_doc, root_school_names[root_link]))
+
+    crawled_links, freshly_crawled = _crawl(list(root_school_names), max_pages, page_handler=ingest_page)
     
     for school in school_links:
         school_name = school['name']
         if 'root' in school:
             root_link = school['root']
-            links = crawl_links(root_link)
+            links = crawled_links[root_link]
             print(f"For root link: {root_link}, found {len(links)}")
-            school_docs = load_school_links(links, school_name)
+            if root_link in freshly_crawled:
+                school_docs = fetched_docs[root_link]
+                # Pages the crawler could not download fall back to the website cache
+                fetched_links = {doc.doc_id for doc in school_docs}
+                missing_links = [link for link in links if link not in fetched_links]
+                if missing_links:
+                    school_docs = school_docs + load_school_links(missing_links, school_name)
+            else:
+                # Crawl results came from the scraper cache, so the pages come from the website cache
+                school_docs = load_school_links(links, school_name)
             crawled_docs.extend(school_docs)
         else:
             print(f"No root link found for {school_name}")
@@ -1,12 +1,150 @@
 from dotenv import load_dotenv
-import requests
+import asyncio
+import httpx
 import os
 import time
 from datetime import datetime
+from helpers.cache_helper import TTLCache
 
 # Load environment variables
 load_dotenv()
 
+# Point this at a local stand-in to exercise the travel-time functions without the real Maps API
+MAPS_BASE_URL = os.getenv("GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com/maps/api")
+MAPS_REQUEST_TIMEOUT_SECONDS = 10
+TRAVEL_TIME_CACHE_TTL_SECONDS = 60 * 60
+TRAVEL_TIME_BUCKET_SECONDS = 15 * 60  # Requests within the same 15 minutes share a cached result
+
+TRAVEL_TIME_BATCH_WINDOW_SECONDS = 0.05  # Distance Matrix lookups issued within this window share one request
+MAX_MATRIX_SIDE = 25  # Distance Matrix limits: 25 origins or destinations, 100 elements per request
+MAX_MATRIX_ELEMENTS = 100
+
+travel_time_cache = TTLCache(TRAVEL_TIME_CACHE_TTL_SECONDS)
+
+_http_client = None
+_http_client_loop = None
+
+def get_http_client():
+    # One pooled client per event loop, reused across requests and sessions
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            timeout=MAPS_REQUEST_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10))
+        _http_client_loop = loop
+    return _http_client
+
+async def _get_json(endpoint, params):
+    params = {**params, 'key': os.getenv("GOOGLE_MAPS_API_KEY"), 'units': 'imperial'}
+    response = await get_http_client().get(f"{MAPS_BASE_URL}/{endpoint}/json", params=params)
+    return response.json()
+
+def _normalize_location(location):
+    return " ".join(location.lower().split())
+
+def _time_bucket(timestamp):
+    if timestamp == "now":
+        timestamp = time.time()
+    return int(timestamp) // TRAVEL_TIME_BUCKET_SECONDS
+
+def _cache_key(kind, origin, destination, mode, timestamp="now"):
+    return (kind, _normalize_location(origin), _normalize_location(destination), mode, _time_bucket(timestamp))
+
+def _unique(items):
+    return list(dict.fromkeys(items))
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class TravelTimeBatcher:
+    """Coalesces Distance Matrix lookups made close together into one request per mode and departure time."""
+
+    def __init__(self, window_seconds=TRAVEL_TIME_BATCH_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._pending = {}  # (mode, departure_time) -> [(origin, destination, future)]
+        self._flush_tasks = set()
+        self.requests_sent = 0
+        self.lookups = 0
+
+    async def load(self, origin, destination, mode="driving", departure_time=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        group_key = (mode, departure_time)
+        if group_key not in self._pending:
+            self._pending[group_key] = []
+            loop.call_later(self.window_seconds, self._schedule_flush, group_key)
+        self._pending[group_key].append((_normalize_location(origin), _normalize_location(destination), future))
+        self.lookups += 1
+        return await future
+
+    def _schedule_flush(self, group_key):
+        # Keep a reference so the flush task is not garbage collected while it runs
+        task = asyncio.ensure_future(self._flush(group_key))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self, group_key):
+        mode, departure_time = group_key
+        lookups = [lookup for lookup in self._pending.pop(group_key, []) if not lookup[2].done()]
+        if not lookups:
+            return
+
+        origins = _unique(origin for origin, _, _ in lookups)
+        destinations = _unique(destination for _, destination, _ in lookups)
+        if len(origins) <= MAX_MATRIX_SIDE and len(destinations) <= MAX_MATRIX_SIDE \
+                and len(origins) * len(destinations) <= MAX_MATRIX_ELEMENTS:
+            matrices = [(origins, destinations)]
+        else:
+            # Too large for one request: one request per origin with its own destinations
+            matrices = []
+            for origin in origins:
+                origin_destinations = _unique(d for o, d, _ in lookups if o == origin)
+                matrices.extend(([origin], chunk) for chunk in _chunks(origin_destinations, MAX_MATRIX_SIDE))
+
+        results = {}
+        try:
+            for matrix_origins, matrix_destinations in matrices:
+                results.update(await self._fetch_matrix(matrix_origins, matrix_destinations, mode, departure_time))
+        except Exception as e:
+            # Never leave a waiting tool call hanging; unresolved lookups get the error result
+            print(f"Travel time batch failed: {e}")
+
+        for origin, destination, future in lookups:
+            if not future.done():
+                future.set_result(results.get((origin, destination)))
+
+    async def _fetch_matrix(self, origins, destinations, mode, departure_time):
+        params = {
+            'origins': "|".join(origins),
+            'destinations': "|".join(destinations),
+            'mode': mode,
+        }
+        if departure_time is not None:
+            params['departure_time'] = departure_time
+            params['traffic_model'] = 'best_guess'
+        duration_field = 'duration' if departure_time is None else 'duration_in_traffic'
+
+        self.requests_sent += 1
+        print(f"Distance Matrix request: {len(origins)} origins x {len(destinations)} destinations ({mode})")
+        try:
+            data = await _get_json("distancematrix", params)
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Travel time request failed: {e}")
+            return {}
+
+        results = {}
+        if data['status'] == 'OK':
+            for origin, row in zip(origins, data['rows']):
+                for destination, element in zip(destinations, row['elements']):
+                    if element['status'] == 'OK' and duration_field in element:
+                        results[(origin, destination)] = element[duration_field]['text']
+        return results
+
+
+travel_time_batcher = TravelTimeBatcher()
+
 def sanitize_time(time_str):
     if time_str == "now":
         return "now"
@@ -21,83 +159,74 @@ def sanitize_time(time_str):
         return timestamp
     except ValueError as e:
         return {"error": str(e)}
-        
-def get_travel_time(origin, destination, mode="driving"):
-    url = f"https://maps.googleapis.com/maps/api/distancematrix/json"
-    params = {
-        'origins': origin,
-        'destinations': destination,
-        'mode': mode,
-        'key': os.getenv("GOOGLE_MAPS_API_KEY"),
-        'units': 'imperial'
-    }
-    response = requests.get(url, params=params)
-    data = response.json()
-    
-    # print("Response:". data)
 
-    if data['status'] == 'OK':
-        travel_time = data['rows'][0]['elements'][0]['duration']['text']
+async def get_travel_time(origin, destination, mode="driving"):
+    cache_key = _cache_key("travel", origin, destination, mode)
+    cached = travel_time_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Concurrent calls with the same mode are merged into one Distance Matrix request
+    travel_time = await travel_time_batcher.load(origin, destination, mode)
+    if travel_time is not None:
+        travel_time_cache.set(cache_key, travel_time)
         return travel_time
     else:
         return "Error fetching data"
 
-def get_travel_time_based_on_arrival_time(origin, destination, arrival_time, mode="driving"):
-    url = "https://maps.googleapis.com/maps/api/directions/json"
-    
+async def get_travel_time_based_on_arrival_time(origin, destination, arrival_time, mode="driving"):
     sanitized_time = sanitize_time(arrival_time)
     if isinstance(sanitized_time, dict) and "error" in sanitized_time:
         return sanitized_time["error"]
-    
+
+    cache_key = _cache_key("arrival", origin, destination, mode, sanitized_time)
+    cached = travel_time_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     params = {
         'origin': origin,
         'destination': destination,
         'mode': mode,
         'arrival_time': sanitized_time,
-        'key': os.getenv("GOOGLE_MAPS_API_KEY"),
-        'units': 'imperial'
     }
-    response = requests.get(url, params=params)
-    data = response.json()
+    try:
+        data = await _get_json("directions", params)
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Arrival time request failed: {e}")
+        return "Error fetching arrival time"
     # print("Response:", data)
 
     if data['status'] == 'OK':
         route = data['routes'][0]
         leg = route['legs'][0]
         duration = leg['duration']['text']
+        travel_time_cache.set(cache_key, duration)
         return duration
     else:
         return "Error fetching arrival time"
-    
-def get_travel_time_based_on_departure_time(origin, destination, departure_time, mode="driving"):
-    url = f"https://maps.googleapis.com/maps/api/distancematrix/json"
-    
+
+async def get_travel_time_based_on_departure_time(origin, destination, departure_time, mode="driving"):
     sanitized_time = sanitize_time(departure_time)
     if isinstance(sanitized_time, dict) and "error" in sanitized_time:
         return sanitized_time["error"]
-    
-    params = {
-        'origins': origin,
-        'destinations': destination,
-        'mode': mode,
-        'departure_time': sanitized_time,
-        'traffic_model': 'best_guess',
-        'key': os.getenv("GOOGLE_MAPS_API_KEY"),
-        'units': 'imperial'
-    }
-    response = requests.get(url, params=params)
-    data = response.json()
-    # print("Response:", data)
 
-    if data['status'] == 'OK':
-        travel_time = data['rows'][0]['elements'][0]['duration_in_traffic']['text']
+    cache_key = _cache_key("departure", origin, destination, mode, sanitized_time)
+    cached = travel_time_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Concurrent calls with the same mode and departure time are merged into one Distance Matrix request
+    travel_time = await travel_time_batcher.load(origin, destination, mode, sanitized_time)
+    if travel_time is not None:
+        travel_time_cache.set(cache_key, travel_time)
         return travel_time
     else:
         return "Error fetching departure time"
 
-    
+
     # travel_time = get_travel_time("1600 Amphitheatre Parkway, Mountain View, CA 94043", "189 Vassar St, Cambridge, MA 02139")
     # print("Travel time without arrival time: " + travel_time)
 
     # travel_time = get_travel_time_based_on_arrival_time("1600 Amphitheatre Parkway, Mountain View, CA 94043", "189 Vassar St, Cambridge, MA 02139", "10:00 AM")
-    # print("Travel time with arrival time: " + travel_time)
\ No newline at end of file
+    # print("Travel time with arrival time: " + travel_time)
@@ -1,11 +1,13 @@
 import os
+import sys
 import json
+import threading
+import time
 from langsmith import traceable
-from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
+from llama_index.core import VectorStoreIndex, StorageContext, Settings, load_index_from_storage
 from llama_index.core.retrievers import VectorIndexRetriever, BaseRetriever
 from llama_index.core.query_engine import RetrieverQueryEngine, TransformQueryEngine
 from datetime import datetime, timedelta
-from thefuzz import fuzz
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -16,8 +18,25 @@ if os.getenv("USE_PRIVATE_LINKS"):
 else:
     from links import school_links# This file should have your list of URLs and info
 
-from helpers.web_helper import load_non_root_links, load_crawled_links
-from helpers.pdf_helper import load_pdfs_from_directory
+from helpers.web_helper import load_non_root_links, load_crawled_links, get_listed_links, get_crawled_links
+from helpers.pdf_helper import load_pdfs_from_directory, find_pdf_files
+from helpers.cache_helper import delete_cache_entry, WEBSITE_CACHE, PDF_CACHE
+from helpers.school_helper import SchoolResolver
+from helpers.embedding_helper import CachedEmbedding
+from helpers.token_helper import count_tokens, truncate_to_tokens
+from config.config_app import RAG_CONTEXT_TOKEN_BUDGET, RAG_CONTEXT_MIN_CHUNK_TOKENS
+
+# Built once from the configured schools and PDF folders; resolutions are memoized
+school_resolver = SchoolResolver(school_links, 'private_data')
+
+_embed_model = None
+
+def get_embed_model():
+    # Chunk embeddings are served from the on-disk cache, so rebuilds only embed new or changed text
+    global _embed_model
+    if _embed_model is None:
+        _embed_model = CachedEmbedding(Settings.embed_model)
+    return _embed_model
 
 def get_schools_with_data():
     list =  [school["name"] for school in school_links]
@@ -33,9 +52,46 @@ def load_all_data():
     # Load URLs from crawling root links
     crawled_docs = load_crawled_links(school_links)
 
-    # Combine all documents
-    combined_docs = pdf_docs + web_docs + crawled_docs
-    return combined_docs
+    # Combine all documents; a page can be both listed and crawled, keep one document per source
+    combined_docs = {}
+    for doc in pdf_docs + web_docs + crawled_docs:
+        combined_docs.setdefault(doc.doc_id, doc)
+    return list(combined_docs.values())
+
+def get_source_ids():
+    # Ids of every source that still exists, whether or not it could be loaded in this run
+    source_ids = {link for link, _ in get_listed_links(school_links)}
+    # load_all_data has just refreshed the crawl results, or kept the previous ones if a site was down
+    root_links = [school['root'] for school in school_links if 'root' in school]
+    for links in get_crawled_links(root_links).values():
+        source_ids.update(links)
+    source_ids.update(os.path.join(dir_path, file_name) for file_name, dir_path, _ in find_pdf_files('private_data'))
+    return source_ids
+
+PERSIST_DIR = "persisted_data"
+INDEX_VERSION_FILE = "index_version"
+INDEX_VERSION_CHECK_SECONDS = 5  # How often the persisted index is checked for changes
+
+
+def _write_index_version(persist_dir=PERSIST_DIR):
+    # Written last (and atomically) so a changed version always points at a fully persisted index
+    version_path = os.path.join(persist_dir, INDEX_VERSION_FILE)
+    tmp_path = version_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp_path, version_path)
+
+def get_index_version(persist_dir=PERSIST_DIR):
+    version_path = os.path.join(persist_dir, INDEX_VERSION_FILE)
+    if os.path.exists(version_path):
+        with open(version_path, 'r') as f:
+            return f.read().strip()
+
+    # Indexes persisted before the version marker existed fall back to the docstore mtime
+    docstore_path = os.path.join(persist_dir, "docstore.json")
+    if os.path.exists(docstore_path):
+        return str(os.path.getmtime(docstore_path))
+    return None
 
 def create_index():
     docs = load_all_data()
@@ -44,72 +100,174 @@ def create_index():
     storage_context = StorageContext.from_defaults()
     
     # Create the index with storage context
-    index = VectorStoreIndex.from_documents(docs, storage_context=storage_context)
+    index = VectorStoreIndex.from_documents(docs, storage_context=storage_context, embed_model=get_embed_model())
+    print(f"Embedding cache: {get_embed_model().stats()}")
     
     # Save index to disk
-    storage_context.persist(persist_dir="persisted_data")
+    storage_context.persist(persist_dir=PERSIST_DIR)
+    _write_index_version()
+    return index
+
+
+def refresh_index():
+    # Re-embed only what changed: documents are matched by their stable id (URL / PDF path) and content hash
+    if get_index_version() is None:
+        return create_index()
+
+    docs = load_all_data()
+    index = load_index()  # A private copy; the served index is swapped in once the new version is persisted
+    existing_ids = set(index.ref_doc_info.keys())
+    current_ids = {doc.doc_id for doc in docs}
+
+    # Inserts new documents and re-embeds documents whose hash changed
+    refreshed = index.refresh_ref_docs(docs)
+    changed_ids = [doc.doc_id for doc, was_refreshed in zip(docs, refreshed) if was_refreshed]
+    inserted = [doc_id for doc_id in changed_ids if doc_id not in existing_ids]
+    updated = [doc_id for doc_id in changed_ids if doc_id in existing_ids]
+
+    # Only sources that are gone from the links, the crawl or the PDF folder are removed; a source that
+    # merely failed to load this run keeps its chunks
+    source_ids = get_source_ids()
+    removed = [doc_id for doc_id in existing_ids if doc_id not in current_ids and doc_id not in source_ids]
+    for doc_id in removed:
+        index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        # Ids are URLs or PDF paths, so at most one of these namespaces holds an entry
+        delete_cache_entry(WEBSITE_CACHE, doc_id)
+        delete_cache_entry(PDF_CACHE, doc_id)
+
+    print(f"Index refresh: {len(inserted)} inserted, {len(updated)} updated, {len(removed)} removed, "
+          f"{len(docs) - len(changed_ids)} unchanged")
+    print(f"Embedding cache: {get_embed_model().stats()}")
+    if changed_ids or removed:
+        index.storage_context.persist(persist_dir=PERSIST_DIR)
+        _write_index_version()
     return index
 
 
 # Load the index from disk
 def load_index():
     # Load the storage context
-    storage_context = StorageContext.from_defaults(persist_dir="persisted_data")
+    storage_context = StorageContext.from_defaults(persist_dir=PERSIST_DIR)
     
     # Load the index from the storage context
-    index = load_index_from_storage(storage_context)
+    index = load_index_from_storage(storage_context, embed_model=get_embed_model())
     
     return index
 
-class SchoolAwareRetriever(BaseRetriever):
-    def __init__(self, base_retriever, school_name, similarity_threshold=70):
-        self.base_retriever = base_retriever
-        self.school_name = school_name.lower()
-        self.similarity_threshold = similarity_threshold
 
-    def _retrieve(self, query, **kwargs):
-        nodes = self.base_retriever.retrieve(query, **kwargs)
-        
-        if self.school_name:
-            # Calculate similarity scores for all nodes
-            scored_nodes = [
-                (node, fuzz.partial_ratio(self.school_name, node.metadata.get('school', '').lower()))
-                for node in nodes
-            ]
-            
-            # Sort nodes by similarity score in descending order
-            scored_nodes.sort(key=lambda x: x[1], reverse=True)
-            
-            # If we have any matches above the threshold, use the highest score
-            if scored_nodes and scored_nodes[0][1] >= self.similarity_threshold:
-                highest_score = scored_nodes[0][1]
-                school_nodes = [node for node, score in scored_nodes if score == highest_score]
+def build_school_node_ids(index):
+    # Posting list of school id -> node ids, so retrieval can be restricted to a single school
+    school_node_ids = {}
+    for node_id, node in index.docstore.docs.items():
+        school = node.metadata.get('school')
+        if school:
+            school_id = school_resolver.resolve(school) or school.lower()
+            school_node_ids.setdefault(school_id, []).append(node_id)
+    return school_node_ids
+
+
+class IndexHolder:
+    """Process-wide holder that loads the index once and swaps it when the persisted version changes."""
+
+    def __init__(self, persist_dir=PERSIST_DIR, check_interval=INDEX_VERSION_CHECK_SECONDS):
+        self.persist_dir = persist_dir
+        self.check_interval = check_interval
+        self._reload_lock = threading.Lock()
+        # (index, school_node_ids) are swapped together so a query never sees a mismatched pair
+        self._state = None
+        self._version = None
+        self._last_check = 0.0
+
+    def get_state(self):
+        state = self._state
+        if state is not None and time.monotonic() - self._last_check < self.check_interval:
+            return state
+
+        # Only the first load blocks; while a reload is running other callers keep the current index
+        if not self._reload_lock.acquire(blocking=state is None):
+            return state
+        try:
+            self._last_check = time.monotonic()
+            version = get_index_version(self.persist_dir)
+            if self._state is not None and version == self._version:
+                return self._state
+
+            if version is None:
+                print("Creating new index...")
+                index = create_index()
+                version = get_index_version(self.persist_dir)
             else:
-                # If no matches above threshold, return an empty list
-                school_nodes = []
-            
-            return school_nodes
+                print(f"Loading existing index (version {version})...")
+                index = load_index()
+
+            # Queries already running keep their reference to the previous index
+            self._state = (index, build_school_node_ids(index))
+            self._version = version
+            return self._state
+        finally:
+            self._reload_lock.release()
+
+    def get_index(self):
+        return self.get_state()[0]
+
+    @property
+    def version(self):
+        return self._version
+
+
+_index_holder = IndexHolder()
+
+def get_index():
+    return _index_holder.get_index()
+
+def get_served_index_version():
+    # Version of the index queries are currently answered from, used to invalidate cached answers
+    return _index_holder.version
+
+class SchoolAwareRetriever(BaseRetriever):
+    def __init__(self, index, school_node_ids, school_name, similarity_top_k=10):
+        super().__init__()
+        self.school_name = school_name
+        self.school_id = school_resolver.resolve(school_name)
+
+        node_ids = school_node_ids.get(self.school_id, [])
+        if node_ids:
+            # The vector search only scores this school's nodes, so top-k is a true per-school top-k
+            self.base_retriever = VectorIndexRetriever(
+                index=index,
+                similarity_top_k=similarity_top_k,
+                node_ids=node_ids,
+            )
         else:
-            # If no specific school is set, return all nodes
-            return nodes
+            self.base_retriever = None
 
-def get_query_engine(school_name = None):
-    if not os.path.exists("persisted_data/docstore.json"):
-        print("Creating new index...")
-        index = create_index()
-    else:
-        print("Loading existing index...")
-        index = load_index()
+    def _retrieve(self, query_bundle):
+        if self.base_retriever is None:
+            # If the school has no data, return an empty list
+            return []
+        return self.base_retriever.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle):
+        # Async path: the query embedding is awaited instead of blocking the event loop
+        if self.base_retriever is None:
+            return []
+        return await self.base_retriever.aretrieve(query_bundle)
+
+def get_retriever(school_name = None):
+    index, school_node_ids = _index_holder.get_state()
 
-    base_retriever = VectorIndexRetriever(
-        index=index,
-        similarity_top_k=10,
-    )
     if school_name:
-        retriever = SchoolAwareRetriever(base_retriever, school_name)
-        print(f"Using school-aware retriever for {school_name}")
+        retriever = SchoolAwareRetriever(index, school_node_ids, school_name)
+        print(f"Using school-aware retriever for {school_name} (resolved to: {retriever.school_id})")
     else:
-        retriever = base_retriever
+        retriever = VectorIndexRetriever(
+            index=index,
+            similarity_top_k=10,
+        )
+    return retriever
+
+def get_query_engine(school_name = None):
+    retriever = get_retriever(school_name)
         
     query_engine = RetrieverQueryEngine.from_args(
         retriever=retriever,
@@ -141,6 +299,36 @@ def get_sources(source_nodes, max_sources=3, relevance_threshold=0.8):
     
     
 
+def build_retrieval_context(source_nodes, token_budget=RAG_CONTEXT_TOKEN_BUDGET):
+    # Retrieval-only mode: the best chunks become the context directly, deduplicated and trimmed to the budget
+    chunks = []
+    sources = []
+    seen_texts = set()
+    used_tokens = 0
+    for node in sorted(source_nodes, key=lambda node: node.score or 0.0, reverse=True):
+        text = node.node.get_content().strip()
+        # The same page is often indexed from several links, so compare whitespace-normalized text
+        normalized_text = ' '.join(text.lower().split())
+        if not text or normalized_text in seen_texts:
+            continue
+        seen_texts.add(normalized_text)
+
+        remaining_tokens = token_budget - used_tokens
+        if remaining_tokens < RAG_CONTEXT_MIN_CHUNK_TOKENS:
+            break
+        tokens = count_tokens(text)
+        if tokens > remaining_tokens:
+            text = truncate_to_tokens(text, remaining_tokens)
+            tokens = remaining_tokens
+        used_tokens += tokens
+
+        metadata = node.node.metadata
+        source_label = f"{metadata.get('source', 'Unknown')} ({metadata.get('type', 'Unknown')})"
+        chunks.append(f"[{len(chunks) + 1}] {source_label}:\n{text}")
+        sources.append({"content": text, "metadata": metadata, "score": node.score or 0.0})
+
+    return "\n\n".join(chunks), sources
+
 def format_response_with_sources(answer, sources):
     formatted_response = f"Answer: {answer}\n\nSources:\n"
         
@@ -162,6 +350,10 @@ def format_response_with_sources(answer, sources):
     return formatted_response
 
 if __name__ == "__main__":
+    # python rag_pipeline.py refresh: update the persisted index with new, changed and removed sources
+    if len(sys.argv) > 1 and sys.argv[1] == "refresh":
+        refresh_index()
+        sys.exit(0)
     
     # Test query
     queries = [
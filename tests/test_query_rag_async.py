@@ -0,0 +1,113 @@
+import asyncio
+import importlib
+import os
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RETRIEVAL_SECONDS = 0.5
+STREAM_TOKENS = 40
+STREAM_TOKEN_INTERVAL_SECONDS = 0.005
+
+
+class FakeMessage:
+    """Stands in for cl.Message and records when each frame is sent."""
+
+    def __init__(self):
+        self.frames = []
+
+    async def stream_token(self, token):
+        self.frames.append((time.perf_counter(), token))
+
+
+class FakeResponse:
+    source_nodes = []
+
+    def __str__(self):
+        return "Tuition is listed on the admissions page."
+
+
+class SlowQueryEngine:
+    async def aquery(self, query_bundle):
+        # Stands in for the embedding, retrieval and synthesis round trips
+        await asyncio.sleep(RETRIEVAL_SECONDS)
+        return FakeResponse()
+
+
+class SlowRetriever:
+    async def aretrieve(self, query_bundle):
+        await asyncio.sleep(RETRIEVAL_SECONDS)
+        return []
+
+
+class FakeEmbedModel:
+    async def aget_query_embedding(self, query):
+        return [1.0, 0.0, 0.0]
+
+
+def _fake_rag_pipeline():
+    # app loads the index at import time; the test only needs query_rag's collaborators
+    module = types.ModuleType("rag_pipeline")
+    module.get_index = lambda: None
+    module.get_query_engine = lambda school_name=None: SlowQueryEngine()
+    module.get_retriever = lambda school_name=None: SlowRetriever()
+    module.get_schools_with_data = lambda: ""
+    module.get_sources = lambda source_nodes: []
+    module.build_retrieval_context = lambda source_nodes: ("", [])
+    module.get_embed_model = lambda: FakeEmbedModel()
+    module.get_served_index_version = lambda: 1
+    module.school_resolver = types.SimpleNamespace(
+        resolve=lambda mention: mention.lower(), find_schools=lambda text: [])
+    return module
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    for module_name in ("chainlit", "openai", "langsmith", "llama_index.core", "numpy", "tiktoken"):
+        pytest.importorskip(module_name)
+    monkeypatch.setenv("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY") or "test-key")
+    monkeypatch.setitem(sys.modules, "rag_pipeline", _fake_rag_pipeline())
+    for module_name in ("app", "config.config_llm"):
+        monkeypatch.delitem(sys.modules, module_name, raising=False)
+    app = importlib.import_module("app")
+    yield app
+    sys.modules.pop("app", None)
+
+
+@pytest.mark.parametrize("response_mode", ["compact", "retrieval"])
+def test_sessions_keep_streaming_during_slow_retrieval(app_module, monkeypatch, response_mode):
+    from helpers.stream_helper import TokenStreamer
+
+    monkeypatch.setattr(app_module, "RAG_RESPONSE_MODE", response_mode)
+    message = FakeMessage()
+    streamer = TokenStreamer(message, window_seconds=0.01, max_chars=8)
+
+    async def other_session():
+        # Another user's response streaming while this session waits on the RAG
+        for i in range(STREAM_TOKENS):
+            await streamer.push(f"token{i} ")
+            await asyncio.sleep(STREAM_TOKEN_INTERVAL_SECONDS)
+        await streamer.close()
+
+    async def rag_session():
+        result = await app_module.query_rag(None, [], "What is the tuition?", "Harker")
+        return result, time.perf_counter()
+
+    async def scenario():
+        start_time = time.perf_counter()
+        (result, rag_finished_at), _ = await asyncio.gather(rag_session(), other_session())
+        return start_time, result, rag_finished_at
+
+    start_time, (rag_context, sources), rag_finished_at = asyncio.run(scenario())
+
+    assert rag_finished_at - start_time >= RETRIEVAL_SECONDS
+    frames_during_retrieval = [sent_at for sent_at, _ in message.frames if sent_at < rag_finished_at]
+    # A retrieval that blocked the event loop would hold every frame back until it finished
+    assert len(frames_during_retrieval) >= STREAM_TOKENS // 2
+    assert message.frames[0][0] - start_time < RETRIEVAL_SECONDS / 2
+    assert "".join(token for _, token in message.frames) == streamer.text
+    assert isinstance(rag_context, str)
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers.school_helper import SchoolResolver
+
+SCHOOL_LINKS = [
+    {"name": "The Harker School", "root": "https://www.harker.org"},
+    {"name": "Nueva School", "root": "https://www.nuevaschool.org"},
+    {"name": "Keys School", "root": "https://www.keysschool.org"},
+    {"name": "Khan Lab School", "root": "https://khanlabschool.org"},
+    {"name": "Pinewood School", "root": "https://www.pinewood.edu"},
+]
+
+
+@pytest.fixture
+def resolver():
+    return SchoolResolver(SCHOOL_LINKS)
+
+
+def test_find_schools_matches_exact_mentions(resolver):
+    assert resolver.find_schools("Is Harker closer than Keys?") == ["the harker school", "keys school"]
+    assert resolver.find_schools("Tuition at keysschool.org and Khan Lab") == ["keys school", "khan lab school"]
+
+
+@pytest.mark.parametrize("text", [
+    "What are the key differences between Harker and Nueva?",
+    "What are the key admission deadlines for Harker and Nueva?",
+])
+def test_find_schools_ignores_common_words_that_stem_to_an_alias(resolver, text):
+    # "key" only matches the stemmed alias of Keys School, which free text must not name by accident
+    assert resolver.find_schools(text) == ["the harker school", "nueva school"]
+
+
+@pytest.mark.parametrize("mention, school_id", [
+    ("Harker", "the harker school"),
+    ("Harker lower campus", "the harker school"),
+    ("Khan Labs", "khan lab school"),
+    ("Khan", "khan lab school"),
+    ("pinewod", "pinewood school"),
+])
+def test_resolve_matches_partial_and_misspelled_names(resolver, mention, school_id):
+    assert resolver.resolve(mention) == school_id
+
+
+@pytest.mark.parametrize("mention", ["Khan Academy", "Keys Academy", "Harker Academy", "Stanford"])
+def test_resolve_returns_none_for_other_schools(resolver, mention):
+    # A guess would answer with another school's data
+    assert resolver.resolve(mention) is None